@@ -1,15 +1,13 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import numpy as np
-from io import BytesIO
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-import re
+import hashlib
+import os
+import tempfile
 import time
 
+from engine import (DataEngine, ColumnarCache, HistoryStore, IncrementalProcessor, VizEngine, ImageCache, FigureRasterizer,
+                    ReportEngine, ResultCache, AnalysisPipeline, SensitivityAnalysis, StageTimer, md_to_html)
+
 # ==========================================
 # 0. 系統設定
 # ==========================================
@@ -35,365 +33,196 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # ==========================================
-# 1. Helper Functions
+# 5. 共用資源 (跨 session 快取)
 # ==========================================
-def md_to_html(text):
-    if not isinstance(text, str): return str(text)
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-    text = text.replace('\n', '<br>')
-    return text
+@st.cache_resource
+def get_result_cache():
+    # 每次分析會存入十餘個階段結果，筆數上限放寬，主要由記憶體預算控制
+    return ResultCache(max_entries=256)
 
-def clean_text_for_word(text):
-    if not isinstance(text, str): return str(text)
-    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-    text = re.sub(r'<b>(.*?)</b>', r'\1', text)
-    text = re.sub(r'<br>', '\n', text)
-    text = re.sub(r'🔴|🟡|🟢', '', text)
-    return text.strip()
+@st.cache_resource
+def get_columnar_cache():
+    return ColumnarCache(os.environ.get("PARSED_CACHE_DIR", os.path.join(tempfile.gettempdir(), "production_arrow_cache")))
 
-# ==========================================
-# 2. Data Engine
-# ==========================================
-class DataEngine:
-    @staticmethod
-    def clean_and_process(df_raw, params):
-        try:
-            df = df_raw.copy()
-            rename_map = {"用電量(kWh)": "耗電量", "產量(雙)": "產量", "OEE(%)": "OEE_RAW", "設備": "機台編號", "機台": "機台編號"}
-            for user_col, sys_col in rename_map.items():
-                if user_col in df.columns: df = df.rename(columns={user_col: sys_col})
-                
-            required_cols = ["機台編號", "耗電量", "產量", "OEE_RAW"]
-            if not all(col in df.columns for col in required_cols):
-                return None, None, f"資料表缺少必要欄位: {[c for c in required_cols if c not in df.columns]}"
-            
-            if "日期" in df.columns:
-                df["日期"] = pd.to_datetime(df["日期"], errors='coerce').dt.date
-                if df["日期"].isnull().any(): return None, None, "日期格式錯誤"
+def history_path():
+    return os.environ.get("HISTORY_DB_PATH", "production_history.sqlite")
 
-            if "廠別" not in df.columns: df["廠別"] = "匯入廠區"
+@st.cache_resource
+def get_history_store():
+    return HistoryStore(history_path())
 
-            df["OEE"] = df["OEE_RAW"].apply(lambda x: x / 100.0 if x > 1.0 else x)
-            df["單位能耗"] = df.apply(lambda row: row["耗電量"] / row["產量"] if row["產量"] > 0 else 0, axis=1)
-            
-            best_energy = df[df["單位能耗"] > 0]["單位能耗"].min()
-            if pd.isna(best_energy): best_energy = 0
-            
-            df["能源損失"] = df.apply(lambda row: max(0, (row["單位能耗"] - best_energy) * row["產量"] * params['elec_price']), axis=1)
-            df["產能損失機會成本"] = df.apply(
-                lambda row: ((params['target_oee']/100 - row["OEE"]) / row["OEE"] * row["產量"] * params['product_margin']) 
-                if 0 < row["OEE"] < params['target_oee']/100 else 0, axis=1
-            )
-            df["總損失"] = df["能源損失"] + df["產能損失機會成本"]
-            
-            group_col = "廠別" if df["廠別"].nunique() > 1 else "機台編號"
-            analysis_scope = "跨廠區分析" if group_col == "廠別" else "單廠設備分析"
-            
-            summary_agg = df.groupby(group_col).agg({
-                "OEE": "mean", "產量": "sum", "耗電量": "sum", 
-                "能源損失": "sum", "產能損失機會成本": "sum", "總損失": "sum"
-            }).reset_index()
-            
-            summary_agg["平均單位能耗"] = summary_agg.apply(
-                lambda row: row["耗電量"] / row["產量"] if row["產量"] > 0 else 0, axis=1
-            )
-            summary_agg = summary_agg.sort_values("OEE", ascending=False)
-            
-            return df, summary_agg, analysis_scope
-        except Exception as e:
-            return None, None, str(e)
+@st.cache_resource
+def get_rasterizer():
+    return FigureRasterizer(cache=ImageCache(cache_dir=os.environ.get("REPORT_IMAGE_CACHE_DIR")))
 
 # ==========================================
-# 3. Insight Engine
+# 6. Main App
 # ==========================================
-class InsightEngine:
-    @staticmethod
-    def generate_narrative(df, summary_agg, group_col, params):
-        texts = {}
-        target_oee = params['target_oee'] / 100.0
-        margin = params['product_margin']
-        
-        avg_oee = df["OEE"].mean()
-        total_loss = df["總損失"].sum()
-        best_m = summary_agg.iloc[0]
-        worst_m = summary_agg.iloc[-1]
-        
-        texts['kpi_summary'] = f"本次分析區間內，整體平均 OEE 為 **{avg_oee:.1%}**。其中 **{best_m[group_col]}** 表現最佳，為全廠標竿；而 **{worst_m[group_col]}** 效率敬陪末座，是造成全廠 **NT$ {total_loss:,.0f}** 潛在損失的主要原因。"
-        
-        eff_gap_pct = 0
-        multiplier_msg = ""
-        if best_m['平均單位能耗'] > 0 and worst_m['平均單位能耗'] > 0:
-            eff_gap_pct = ((worst_m['平均單位能耗'] - best_m['平均單位能耗']) / best_m['平均單位能耗']) * 100
-            multiplier = worst_m['平均單位能耗'] / best_m['平均單位能耗']
-            multiplier_msg = f"換算下來，**{worst_m[group_col]}** 的耗能是標竿機台的 **{multiplier:.1f} 倍**。"
-
-        texts['benchmark_analysis'] = f"""
-        * **標竿設備 ({best_m[group_col]})**：表現最佳，平均 OEE 達 **{best_m['OEE']:.1%}**，單位能耗最低 ({best_m['平均單位能耗']:.5f} kWh/雙)。
-        * **瓶頸設備 ({worst_m[group_col]})**：表現最弱，單位生產成本比標竿高出 **{eff_gap_pct:.1f}%**。{multiplier_msg}
-        """
-        
-        texts['rank_desc'] = f"此圖表顯示各設備的綜合實力排名。數據顯示 **{best_m[group_col]}** 位於頂端，顯示其生產效率最優；反之 **{worst_m[group_col]}** 位於底部，建議優先檢討其作業流程。"
-        texts['dual_desc'] = "此圖對比了各機台的「產出量」與「耗電量」。正常的生產模式應為「高產出伴隨高耗電」。若發現某設備產出極低，但耗電量曲線卻未等比例下降，即代表存在無效能耗。"
-        texts['pie_desc'] = "此圖呈現各設備的總用電量佔比。若非主力生產設備卻佔據過高的用電比例，可能代表設備存在漏電、馬達老化或長時間待機未關機的問題。"
-        texts['unit_desc'] = f"此圖比較生產每一雙鞋的電力成本。**{best_m[group_col]}** 的柱狀最短，代表能源轉換效率最高；數值過高者建議檢查傳動系統阻力或加熱系統保溫效果。"
-
-        potential_prod = 0
-        if worst_m['OEE'] > 0:
-            potential_prod = (best_m['OEE'] - worst_m['OEE']) / worst_m['OEE'] * worst_m['產量']
-        potential_rev = potential_prod * margin
-        texts['opportunity_analysis'] = f"若能將 **{worst_m[group_col]}** 的效率提升至標竿水準，預計本期間可額外生產 **{potential_prod:,.0f} 雙**，相當於挽回 **NT$ {potential_rev:,.0f}** 的營收損失。"
-
-        cv_text = "數據量不足以計算波動率。"
-        if len(df) > 1:
-            cv_series = df.groupby(group_col)["OEE"].std() / df.groupby(group_col)["OEE"].mean()
-            most_stable = cv_series.idxmin()
-            most_unstable = cv_series.idxmax()
-            cv_text = f"**{most_stable}** 生產節奏最穩定 (CV最低)；**{most_unstable}** 波動最大，顯示製程或人員操作存在變異。"
-        texts['stability_analysis'] = cv_text
-        texts['cv_desc'] = "變異係數 (CV) 用於衡量生產穩定度。數值越低代表品質與產出越穩定可控；數值過高則代表生產過程極不穩定。"
-        texts['scatter_desc'] = "此矩陣圖用於檢視效率與能耗的關聯。**右下角** (高OEE、低能耗) 為理想落點。若數據點落於 **左上角** (低OEE、高能耗)，通常代表設備處於「空轉浪費」狀態。"
-
-        crit_list, avg_list, good_list = [], [], []
-        for _, row in summary_agg.iterrows():
-            name = row[group_col]
-            if row['OEE'] >= target_oee: good_list.append(name)
-            elif row['OEE'] >= 0.7: avg_list.append(name)
-            else: crit_list.append(name)
-            
-        action_text = ""
-        if crit_list: action_text += f"🔴 **優先改善**：{', '.join(crit_list)}。OEE 低於 70%，請檢查待機未關機狀況。\n\n"
-        if avg_list: action_text += f"🟡 **效能提升**：{', '.join(avg_list)}。表現平穩，建議微調參數提升稼動率。\n\n"
-        if good_list: action_text += f"🟢 **標竿管理**：{', '.join(good_list)}。運作優異，建議標準化SOP。"
-        texts['action_plan'] = action_text
-        return texts
-
-# ==========================================
-# 3. Viz Engine (視覺化中心) - 版面與標籤優化
-# ==========================================
-class VizEngine:
-    @staticmethod
-    def _common_layout():
-        return dict(
-            plot_bgcolor='white',
-            font=dict(family='Arial, sans-serif', color='black', size=12),
-            xaxis=dict(showgrid=True, gridcolor='#f0f0f0'),
-            yaxis=dict(showgrid=True, gridcolor='#f0f0f0'),
-            margin=dict(l=40, r=40, t=40, b=80) # 增加底部 Margin 以防標籤被切掉
-        )
-
-    @staticmethod
-    def create_rank_chart(summary_agg, group_col):
-        try:
-            fig = px.bar(
-                summary_agg.sort_values("OEE", ascending=True),
-                x="OEE", y=group_col, orientation='h', text="OEE",
-                title="綜合實力排名 (依 OEE 排序)"
-            )
-            fig.update_traces(marker_color='#2E86C1', texttemplate='%{text:.1%}', textposition='outside')
-            fig.update_layout(VizEngine._common_layout())
-            fig.update_layout(xaxis=dict(range=[0, summary_agg['OEE'].max() * 1.25])) 
-            return fig
-        except: return go.Figure()
-
-    @staticmethod
-    def create_cv_chart(df, group_col):
-        try:
-            cv_data = df.groupby(group_col)["OEE"].agg(['mean', 'std'])
-            cv_data['CV'] = (cv_data['std'] / cv_data['mean']) * 100
-            cv_data = cv_data.fillna(0).reset_index()
-            fig = px.bar(cv_data, x=group_col, y="CV", text="CV", title="生產穩定度 (CV變異係數)")
-            fig.update_traces(marker_color='#C0392B', texttemplate='%{text:.1f}%', textposition='outside')
-            fig.update_layout(VizEngine._common_layout())
-            fig.update_layout(yaxis=dict(range=[0, cv_data['CV'].max() * 1.2])) # 增加頂部空間
-            return fig
-        except: return go.Figure()
-
-    @staticmethod
-    def create_scatter_chart(df, group_col):
-        try:
-            fig = px.scatter(
-                df, x="OEE", y="單位能耗", color=group_col, size="產量",
-                title="效率 vs 能耗 關聯分析",
-                color_discrete_sequence=px.colors.qualitative.Set1
-            )
-            fig.update_layout(VizEngine._common_layout())
-            return fig
-        except: return go.Figure()
-
-    @staticmethod
-    def create_dual_axis_chart(df, group_col):
-        try:
-            df_sorted = df.sort_values(["日期", group_col])
-            # 修正：日期只顯示 MM-DD (不含年份)，避免標籤太長
-            x_label = df_sorted["日期"].apply(lambda x: x.strftime('%m-%d')) + " " + df_sorted[group_col].astype(str)
-            
-            fig = go.Figure()
-            
-            # 自動分配顏色
-            machines = df[group_col].unique()
-            colors = px.colors.qualitative.Plotly
-            
-            for i, machine in enumerate(machines):
-                m_data = df_sorted[df_sorted[group_col] == machine]
-                # 修正：篩選後的 x_label
-                m_x_label = m_data["日期"].apply(lambda x: x.strftime('%m-%d')) + " " + m_data[group_col].astype(str)
-                color = colors[i % len(colors)]
-                
-                fig.add_trace(go.Bar(
-                    x=m_x_label, y=m_data["產量"], 
-                    name=f"{machine} 產量",
-                    marker_color=color, opacity=0.6
-                ))
-                fig.add_trace(go.Scatter(
-                    x=m_x_label, y=m_data["耗電量"], 
-                    name=f"{machine} 耗電",
-                    yaxis="y2", mode="lines+markers",
-                    line=dict(color=color, width=3)
-                ))
-
-            layout = VizEngine._common_layout()
-            layout.update(dict(
-                title="各機台產量與耗電量趨勢對比",
-                yaxis=dict(title="產量 (雙)"),
-                yaxis2=dict(title="耗電量 (kWh)", overlaying="y", side="right", showgrid=False),
-                xaxis=dict(tickangle=45), # 標籤旋轉
-                barmode='group',
-                legend=dict(orientation="h", y=-0.2) # 圖例移到底部，避免擋住標題
-            ))
-            fig.update_layout(layout)
-            return fig
-        except Exception as e:
-            return go.Figure()
+def render_stream_summary(uploaded_file, params, timer):
+    # 以上傳檔內容雜湊加參數為鍵快取彙總結果，其他元件觸發的重跑不必重新讀取整個檔案
+    with timer.span("上傳檔雜湊"): file_digest, _ = upload_fingerprint(uploaded_file)
+    cache, key = get_result_cache(), AnalysisPipeline.stage_key("stream", file_digest, sorted(params.items()))
+    result = cache.get(key)
+    if result is None:
+        with st.spinner('正在分塊讀取與彙總...'), timer.span("串流讀取與彙總"):
+            uploaded_file.seek(0)
+            result = DataEngine.process_csv_stream(uploaded_file, params)
+        if result[0] is not None: cache.put(key, result, AnalysisPipeline._nbytes(result))
+    summary_res, kpis, scope_res = result
+    if summary_res is None:
+        st.error(f"串流分析失敗: {scope_res}")
+        return
+    group_col = "廠別" if scope_res == "跨廠區分析" else "機台編號"
 
-    @staticmethod
-    def create_pie_chart(summary_agg, group_col):
-        try:
-            fig = px.pie(summary_agg, values="耗電量", names=group_col, hole=0.4, title="總耗電量佔比")
-            fig.update_traces(textinfo='percent+label', textfont=dict(size=14, color='black'), marker=dict(colors=px.colors.qualitative.Safe))
-            fig.update_layout(VizEngine._common_layout())
-            return fig
-        except: return go.Figure()
+    st.markdown("---")
+    st.header(f"串流彙總結果 ({scope_res})")
+    k1, k2, k3 = st.columns(3)
+    k1.metric("資料筆數", f"{kpis['rows']:,}")
+    k2.metric("平均 OEE", f"{kpis['avg_oee']:.1%}")
+    k3.metric("潛在總損失", f"NT$ {kpis['total_loss']:,.0f}")
+    if kpis['date_min'] is not None: st.caption(f"期間：{kpis['date_min']:%Y-%m-%d} ~ {kpis['date_max']:%Y-%m-%d}")
+    st.dataframe(summary_res.style.format({"OEE": "{:.1%}", "平均單位能耗": "{:.5f}", "總損失": "${:,.0f}"}).background_gradient(subset=["OEE"], cmap="Blues"), use_container_width=True)
+    with timer.span("圖表建立"):
+        figs = [VizEngine.create_rank_chart(summary_res, group_col), VizEngine.create_pie_chart(summary_res, group_col),
+                VizEngine.create_unit_energy_chart(summary_res, group_col)]
+    for fig in figs: st.plotly_chart(fig, use_container_width=True)
 
-    @staticmethod
-    def create_unit_energy_chart(summary_agg, group_col):
-        try:
-            sorted_agg = summary_agg.sort_values("平均單位能耗")
-            fig = px.bar(
-                sorted_agg, x=group_col, y="平均單位能耗", text="平均單位能耗",
-                title="平均單位能耗 (越低越好)"
-            )
-            fig.update_traces(marker_color='#145a32', texttemplate='%{text:.5f}', textposition='outside')
-            layout = VizEngine._common_layout()
-            layout.update(yaxis=dict(range=[0, sorted_agg['平均單位能耗'].max() * 1.2]))
-            fig.update_layout(layout)
-            return fig
-        except: return go.Figure()
+@st.fragment
+def render_what_if(edited_df, params, input_key, summary_res, process):
+    """參數模擬：滑桿變動時只重跑這個區塊，以預先計算的係數依群組數重算損失，不重新逐列計算"""
+    model, group_stats = AnalysisPipeline.what_if(edited_df, params, get_result_cache(), input_key, process)
+    if model is None: return
+    c1, c2, c3 = st.columns(3)
+    sim = {
+        'elec_price': c1.slider("電價 (元/度)", 0.0, max(10.0, params['elec_price'] * 2), float(params['elec_price']), 0.1),
+        'target_oee': c2.slider("目標 OEE (%)", 0.0, 100.0, float(min(params['target_oee'], 100.0)), 0.5),
+        'product_margin': c3.slider("獲利估算 (元/雙)", 0.0, max(50.0, params['product_margin'] * 2), float(params['product_margin']), 0.5),
+    }
+    sim_summary = model.summary(group_stats, sim)
+    k1, k2, k3 = st.columns(3)
+    for col, name in zip((k1, k2, k3), ["總損失", "能源損失", "產能損失機會成本"]):
+        value, base = sim_summary[name].sum(), summary_res[name].sum()
+        col.metric(name, f"NT$ {value:,.0f}", f"{round(value - base):+,}", delta_color="inverse")
+    st.plotly_chart(VizEngine.create_loss_chart(sim_summary, model.group_col), use_container_width=True)
 
-# ==========================================
-# 4. Report Engine
-# ==========================================
-class ReportEngine:
-    @staticmethod
-    def clean_markdown(text):
-        if not isinstance(text, str): return str(text)
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-        text = re.sub(r'🔴|🟡|🟢', '', text)
-        return text.strip()
+def render_timing_panel(timer):
+    """偵錯側欄：列出本次重跑各階段耗時 (巢狀階段以縮排表示)，並可下載 JSON"""
+    if not timer.enabled: return
+    records = timer.records()
+    with st.sidebar:
+        st.markdown("#### ⏱️ 各階段耗時")
+        if not records:
+            st.caption("本次重跑沒有執行任何分析階段 (結果已在快取中)")
+            return
+        table = pd.DataFrame([{"階段": "\u3000" * r['depth'] + r['stage'], "耗時 (ms)": r['seconds'] * 1000} for r in records])
+        fmt = {"耗時 (ms)": "{:,.1f}"}
+        if timer.memory:
+            table["峰值 (MB)"] = [r['peak_bytes'] / 1024 ** 2 for r in records]
+            table["留存 (MB)"] = [r['retained_bytes'] / 1024 ** 2 for r in records]
+            fmt.update({"峰值 (MB)": "{:,.1f}", "留存 (MB)": "{:,.1f}"})
+        st.dataframe(table.style.format(fmt), use_container_width=True, hide_index=True)
+        if timer.objects:
+            st.markdown("#### 🧮 資料副本大小")
+            objects = pd.DataFrame([{"物件": o['object'], "大小 (MB)": o['bytes'] / 1024 ** 2} for o in timer.objects])
+            st.dataframe(objects.style.format({"大小 (MB)": "{:,.1f}"}), use_container_width=True, hide_index=True)
+        st.download_button("下載耗時紀錄 (JSON)", timer.to_json(), f"stage_timing_{pd.Timestamp.now():%Y%m%d_%H%M%S}.json", "application/json")
 
-    @staticmethod
-    def generate_docx(df, summary_agg, texts, figures, analysis_scope):
-        doc = Document()
-        style = doc.styles['Normal']
-        style.font.name = 'Arial'
-        style.font.size = Pt(11)
-        
-        head = doc.add_heading('生產效能診斷分析報告', 0)
-        head.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        doc.add_paragraph(f"分析範圍：{clean_text_for_word(analysis_scope)}")
-        doc.add_paragraph(f"期間：{df['日期'].min()} ~ {df['日期'].max()}")
-        doc.add_paragraph("-" * 60)
-        
-        doc.add_heading('1. 總體績效概覽', level=1)
-        doc.add_paragraph(ReportEngine.clean_markdown(texts['kpi_summary']))
-        
-        table = doc.add_table(rows=1, cols=len(summary_agg.columns))
-        table.style = 'Table Grid'
-        hdr = table.rows[0].cells
-        for i, col in enumerate(summary_agg.columns): hdr[i].text = str(col)
-        
-        for _, row in summary_agg.iterrows():
-            cells = table.add_row().cells
-            for i, val in enumerate(row):
-                col_name = summary_agg.columns[i]
-                if "OEE" in col_name: cells[i].text = f"{val:.1%}"
-                elif "能耗" in col_name: cells[i].text = f"{val:.5f}"
-                elif "損失" in col_name or "產量" in col_name: cells[i].text = f"{val:,.0f}"
-                elif isinstance(val, float): cells[i].text = f"{val:.1f}"
-                else: cells[i].text = str(val)
-        
-        doc.add_heading('2. 深度診斷分析', level=1)
-        doc.add_paragraph(ReportEngine.clean_markdown(texts['benchmark_analysis']))
-        doc.add_paragraph(ReportEngine.clean_markdown(texts['opportunity_analysis']))
-        
-        def add_fig_section(key, title, desc_key):
-            doc.add_heading(title, level=2)
-            if key in figures:
-                try:
-                    img = figures[key].to_image(format="png", width=800, height=400, scale=1.5)
-                    doc.add_picture(BytesIO(img), width=Inches(6.0))
-                except: doc.add_paragraph("[圖表略]")
-            if desc_key in texts:
-                doc.add_paragraph(ReportEngine.clean_markdown(texts[desc_key]))
+def render_history_loader():
+    """從歷史資料庫依期間、廠別與機台查詢明細，載入為目前的分析資料 (不需重新上傳與解析原始檔)"""
+    # 資料庫檔案在第一次存入時才建立，單純開啟頁面不會產生檔案
+    if not os.path.exists(history_path()):
+        st.caption("歷史資料庫尚無資料；完成分析後可將結果存入")
+        return
+    store = get_history_store()
+    catalog = store.catalog()
+    if catalog['date_min'] is None:
+        st.caption("歷史資料庫尚無資料；完成分析後可將結果存入")
+        return
+    c1, c2 = st.columns(2)
+    dates = c1.date_input("期間", (catalog['date_min'].date(), catalog['date_max'].date()),
+                          min_value=catalog['date_min'].date(), max_value=catalog['date_max'].date())
+    plants = c2.multiselect("廠別 (未選取為全部)", catalog['plants'])
+    machines = st.multiselect("機台編號 (未選取為全部)", catalog['machines'])
+    if st.button("載入查詢結果"):
+        # 只選了起日時 (區間未選完) 以起日當天為查詢範圍
+        dates = dates if isinstance(dates, tuple) else (dates,)
+        start, end = (dates[0], dates[-1]) if dates else (None, None)
+        df_hist = store.query(start, end, plants, machines, columns=HistoryStore.INPUT_COLS)
+        if df_hist.empty:
+            st.warning("查無符合條件的資料")
+            return
+        st.session_state.input_data = df_hist
+        st.session_state.editor_version = st.session_state.get('editor_version', 0) + 1
+        st.rerun()
 
-        add_fig_section('rank', '綜合實力排名', 'rank_desc')
-        add_fig_section('dual', '產量與能耗趨勢', 'dual_desc')
-        
-        doc.add_heading('3. 電力耗能分析', level=1)
-        add_fig_section('pie', '總耗電量佔比', 'pie_desc')
-        add_fig_section('unit', '平均單位能耗', 'unit_desc')
-        
-        doc.add_heading('4. 生產穩定性', level=1)
-        doc.add_paragraph(ReportEngine.clean_markdown(texts['stability_analysis']))
-        add_fig_section('cv', 'CV 變異係數', 'cv_desc')
-        add_fig_section('scatter', '效率能耗矩陣', 'scatter_desc')
-        
-        doc.add_heading('5. 策略行動建議', level=1)
-        doc.add_paragraph(ReportEngine.clean_markdown(texts['action_plan']))
-        
-        bio = BytesIO()
-        doc.save(bio)
-        return bio
+def upload_fingerprint(uploaded_file):
+    """回傳上傳檔的內容雜湊與工作表清單 (非 Excel 為 None)；以 file_id 記住結果，重跑時不必重新雜湊"""
+    memo = st.session_state.get('upload_fingerprint')
+    if memo is None or memo[0] != uploaded_file.file_id:
+        data = uploaded_file.getvalue()
+        sheet_names = DataEngine.list_sheets(data) if uploaded_file.name.lower().endswith('.xlsx') else None
+        memo = (uploaded_file.file_id, hashlib.blake2b(data, digest_size=16).hexdigest(), sheet_names)
+        st.session_state.upload_fingerprint = memo
+    return memo[1], memo[2]
 
-# ==========================================
-# 5. Main App
-# ==========================================
-def main():
+def run_app(timer):
     st.markdown("### 📥 數據輸入控制台")
-    uploaded_file = st.file_uploader("匯入生產報表 (Excel/CSV)", type=["xlsx", "csv"], label_visibility="collapsed")
+    uploaded_file = st.file_uploader("匯入生產報表 (Excel/CSV/Parquet/Feather)", type=["xlsx", "csv", "parquet", "feather", "arrow"], label_visibility="collapsed")
+    stream_mode = uploaded_file is not None and uploaded_file.name.endswith('.csv') and \
+        st.checkbox("大型 CSV 串流模式 (分塊讀取，僅產生總表與 KPI)")
+    use_arrow_cache = uploaded_file is not None and not stream_mode and \
+        st.checkbox("保存解析結果為 Arrow 快取 (同一檔案再次匯入時免重新解析)")
     
+    if not stream_mode:
+        with st.expander("📚 從歷史資料庫載入"): render_history_loader()
+
     if 'input_data' not in st.session_state:
         st.session_state.input_data = pd.DataFrame([
             {"日期": "2025-11-17", "廠別": "A廠", "機台編號": "ACO2", "OEE(%)": 50.1, "產量(雙)": 2009.5, "用電量(kWh)": 6.2},
             {"日期": "2025-11-17", "廠別": "A廠", "機台編號": "ACO4", "OEE(%)": 55.4, "產量(雙)": 4416.5, "用電量(kWh)": 9.1},
             {"日期": "2025-11-18", "廠別": "A廠", "機台編號": "ACO2", "OEE(%)": 48.5, "產量(雙)": 1950.0, "用電量(kWh)": 6.0},
         ])
-        st.session_state.input_data['日期'] = pd.to_datetime(st.session_state.input_data['日期']).dt.date
+        st.session_state.input_data['日期'] = pd.to_datetime(st.session_state.input_data['日期'])
     
-    if uploaded_file:
+    if uploaded_file and not stream_mode:
         try:
-            if uploaded_file.name.endswith('.csv'): df_new = pd.read_csv(uploaded_file)
-            else: df_new = pd.read_excel(uploaded_file)
-            rename_map = {"用電量(kWh)": "耗電量", "產量(雙)": "產量", "OEE(%)": "OEE_RAW", "設備": "機台編號", "機台": "機台編號"}
-            for user_col, sys_col in rename_map.items():
-                if user_col in df_new.columns: df_new = df_new.rename(columns={user_col: sys_col})
-            st.session_state.input_data = df_new
+            with timer.span("上傳檔雜湊"): file_digest, sheet_names = upload_fingerprint(uploaded_file)
+            sheets = None
+            if sheet_names is not None:
+                sheets = st.multiselect("選擇工作表", sheet_names, default=sheet_names[:1])
+            upload_key = hashlib.blake2b(f"{file_digest}:{sheets!r}".encode(), digest_size=16).hexdigest()
+            # 同一檔案 (同內容、同工作表) 只解析一次，之後的重跑沿用 session 內的資料與使用者的編輯
+            if st.session_state.get('upload_key') != upload_key:
+                arrow_cache = get_columnar_cache() if use_arrow_cache else None
+                with timer.span("解析上傳檔"):
+                    df_new = arrow_cache.load(upload_key) if arrow_cache else None
+                    if df_new is None:
+                        df_new = DataEngine.read_file(uploaded_file, uploaded_file.name, sheets)
+                        if arrow_cache: arrow_cache.save(upload_key, df_new)
+                for user_col, sys_col in DataEngine.RENAME_MAP.items():
+                    if user_col in df_new.columns: df_new = df_new.rename(columns={user_col: sys_col})
+                # 文字日期 (CSV 等) 先轉為 datetime64，編輯器的日期欄設定才能套用
+                if "日期" in df_new.columns: df_new["日期"] = DataEngine.parse_dates(df_new["日期"])
+                st.session_state.input_data = df_new
+                st.session_state.upload_key = upload_key
+                st.session_state.editor_version = st.session_state.get('editor_version', 0) + 1
         except: st.error("檔案讀取失敗")
 
-    edited_df = st.data_editor(st.session_state.input_data, num_rows="dynamic", use_container_width=True)
-    
-    if st.button("🗑️ 清空所有數據"):
-        st.session_state.input_data = pd.DataFrame(columns=["日期", "廠別", "機台編號", "OEE(%)", "產量(雙)", "用電量(kWh)"])
-        st.rerun()
+    if not stream_mode:
+        # 每次換資料就換 key，避免舊的編輯差異套用到新資料上
+        editor_key = f"input_editor_{st.session_state.get('editor_version', 0)}"
+        # 日期欄保持 datetime64，只在編輯器上以日期格式顯示 (無法解析為日期的欄位維持原樣)
+        input_data = st.session_state.input_data
+        date_config = {"日期": st.column_config.DateColumn("日期", format="YYYY-MM-DD")} \
+            if "日期" in input_data.columns and pd.api.types.is_datetime64_any_dtype(input_data["日期"]) else None
+        edited_df = st.data_editor(input_data, num_rows="dynamic", use_container_width=True, key=editor_key, column_config=date_config)
+        timer.track("session_state.input_data", st.session_state.input_data)
+        timer.track("data_editor 輸出", edited_df)
+        
+        if st.button("🗑️ 清空所有數據"):
+            st.session_state.input_data = pd.DataFrame(columns=["日期", "廠別", "機台編號", "OEE(%)", "產量(雙)", "用電量(kWh)"]).astype({"日期": "datetime64[ns]"})
+            st.session_state.editor_version = st.session_state.get('editor_version', 0) + 1
+            st.rerun()
 
     st.markdown("---")
     st.markdown("#### ⚙️ 分析參數設定")
@@ -403,29 +232,37 @@ def main():
         'target_oee': c2.number_input("目標 OEE (%)", value=85.0, step=0.5),
         'product_margin': c3.number_input("獲利估算 (元/雙)", value=10.0, step=1.0)
     }
+
+    if stream_mode:
+        render_stream_summary(uploaded_file, params, timer)
+        render_timing_panel(timer)
+        return
     
     st.write("")
     col_run, col_export = st.columns([1, 1])
     
     data_ready = False
+    data_key = None
     df_res, summary_res, scope_res, texts_res, figs_res = None, None, None, None, {}
+    sens_res = None
 
     if not edited_df.empty:
         try:
-            df_res, summary_res, scope_res = DataEngine.clean_and_process(edited_df, params)
-            if df_res is not None and summary_res is not None:
-                data_ready = True
-                texts_res = InsightEngine.generate_narrative(df_res, summary_res, 
-                                                           "廠別" if scope_res=="跨廠區分析" else "機台編號", 
-                                                           params)
-                figs_res = {
-                    'rank': VizEngine.create_rank_chart(summary_res, "廠別" if scope_res=="跨廠區分析" else "機台編號"),
-                    'cv': VizEngine.create_cv_chart(df_res, "廠別" if scope_res=="跨廠區分析" else "機台編號"),
-                    'scatter': VizEngine.create_scatter_chart(df_res, "廠別" if scope_res=="跨廠區分析" else "機台編號"),
-                    'dual': VizEngine.create_dual_axis_chart(df_res, "廠別" if scope_res=="跨廠區分析" else "機台編號"),
-                    'pie': VizEngine.create_pie_chart(summary_res, "廠別" if scope_res=="跨廠區分析" else "機台編號"),
-                    'unit': VizEngine.create_unit_energy_chart(summary_res, "廠別" if scope_res=="跨廠區分析" else "機台編號")
-                }
+            with timer.span("資料雜湊"): input_key = AnalysisPipeline.fingerprint(edited_df)
+            data_key = AnalysisPipeline.stage_key(input_key, sorted(params.items()))
+            inc = st.session_state.get('incremental')
+            if inc is None or not inc.matches(st.session_state.input_data):
+                inc = st.session_state.incremental = IncrementalProcessor(st.session_state.input_data, params)
+            else: inc.set_params(params)
+            delta = st.session_state.get(editor_key) or {}
+            # 各階段分別快取：只改參數時沿用清理結果，只重算損失與其下游
+            df_res, summary_res, scope_res, texts_res, figs_res = AnalysisPipeline.run_cached(
+                edited_df, params, get_result_cache(), input_key, process=lambda: inc.process(edited_df, delta, timer), timer=timer)
+            data_ready = df_res is not None and summary_res is not None
+            if data_ready:
+                sens_res = AnalysisPipeline.sensitivity(edited_df, params, get_result_cache(), input_key, timer=timer)
+            timer.track("分析結果 df_res", df_res)
+            timer.track("圖表 (JSON)", figs_res)
         except Exception as e: st.error(f"Error: {e}")
 
     with col_run:
@@ -433,21 +270,49 @@ def main():
         
     with col_export:
         if data_ready:
-            docx = ReportEngine.generate_docx(df_res, summary_res, texts_res, figs_res, scope_res)
-            st.download_button("📥 下載 Word 報告", docx.getvalue(), 
-                             f"生產效能報告_{pd.Timestamp.now().strftime('%Y%m%d')}.docx",
-                             "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+            # 延遲產生：僅在使用者要求時才轉檔圖表並建立 docx，同一份資料只產生一次
+            export_slot = st.empty()
+            report = st.session_state.get('report_docx')
+            if report is None or report[0] != data_key:
+                if export_slot.button("📄 產生 Word 報告"):
+                    bar = export_slot.progress(0.0, text="正在產生 Word 報告...")
+                    with timer.span("產生 Word 報告"):
+                        docx = ReportEngine.generate_docx(df_res, summary_res, texts_res, figs_res, scope_res,
+                                                          progress=lambda done, total: bar.progress(done / total, text=f"正在轉出圖表 {done}/{total}..."),
+                                                          rasterizer=get_rasterizer(), timer=timer, sensitivity=sens_res)
+                    st.session_state.report_docx = report = (data_key, docx.getvalue())
+            if report is not None and report[0] == data_key:
+                export_slot.download_button("📥 下載 Word 報告", report[1], 
+                                 f"生產效能報告_{pd.Timestamp.now().strftime('%Y%m%d')}.docx",
+                                 "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
         else:
             st.button("📥 下載 Word 報告", disabled=True)
 
-    if start_btn and data_ready:
-        with st.spinner('正在進行深度診斷...'):
-            time.sleep(0.5)
+    if data_ready and st.button("💾 存入歷史資料庫"):
+        try:
+            with timer.span("存入歷史資料庫"):
+                source = uploaded_file.name if uploaded_file else "手動輸入"
+                added = get_history_store().append(df_res, input_key, source)
+            # 同日期、廠別、機台的紀錄已存在時以本次資料覆寫，不重複計入
+            updated = len(df_res) - added
+            if added: st.success(f"已新增 {added:,} 筆" + (f"；{updated:,} 筆已在資料庫中，以本次資料更新" if updated else ""))
+            else: st.info("此份資料的紀錄皆已在歷史資料庫中")
+        except ValueError as e: st.error(str(e))
+
+    # 報告顯示後保持開啟，頁面上的選單操作不會讓報告消失
+    if start_btn: st.session_state.show_report = True
+
+    if st.session_state.get('show_report') and data_ready:
+        with st.spinner('正在進行深度診斷...'), timer.span("報告頁面輸出"):
+            if start_btn: time.sleep(0.5)
             st.markdown("---")
             st.title("生產效能診斷分析報告")
             
             st.header("1. 總體績效概覽")
             st.markdown(f'<div class="insight-box">{md_to_html(texts_res["kpi_summary"])}</div>', unsafe_allow_html=True)
+            mem_before, mem_after = DataEngine.memory_report(edited_df, df_res)
+            st.caption(f"資料記憶體：原始欄位 {mem_before / 1024 ** 2:,.1f} MB → 精簡型別後 {mem_after / 1024 ** 2:,.1f} MB"
+                       f" (節省 {1 - mem_after / max(mem_before, 1):.0%})")
             st.subheader("績效總表")
             st.dataframe(summary_res.style.format({"OEE": "{:.1%}", "平均單位能耗": "{:.5f}", "總損失": "${:,.0f}"}).background_gradient(subset=["OEE"], cmap="Blues"), use_container_width=True)
             
@@ -458,7 +323,14 @@ def main():
             st.markdown(f'<div class="analysis-text">{md_to_html(texts_res["benchmark_analysis"])}</div>', unsafe_allow_html=True)
             st.markdown(f'<div class="insight-box">{md_to_html(texts_res["opportunity_analysis"])}</div>', unsafe_allow_html=True)
             st.subheader("產量與能耗趨勢")
-            st.plotly_chart(figs_res['dual'], use_container_width=True)
+            group_col = "廠別" if scope_res == "跨廠區分析" else "機台編號"
+            dual_fig = figs_res['dual']
+            if summary_res[group_col].nunique() > VizEngine.DUAL_MAX_GROUPS:
+                picked = st.multiselect("指定比較對象 (未指定時顯示損失最高的前幾名與其他合計)", summary_res[group_col].tolist())
+                if picked:
+                    trend, freq = DataEngine.rollup_trend(df_res, group_col)
+                    dual_fig = VizEngine.create_dual_axis_chart(trend, group_col, selected=picked, freq=freq)
+            st.plotly_chart(dual_fig, use_container_width=True)
             st.markdown(f'<div class="chart-desc">{md_to_html(texts_res["dual_desc"])}</div>', unsafe_allow_html=True)
             
             st.header("3. 電力耗能深度分析")
@@ -477,5 +349,27 @@ def main():
             st.header("5. 綜合診斷與建議")
             st.markdown(texts_res['action_plan'])
 
+            if sens_res is not None:
+                st.header("6. 參數敏感度分析")
+                st.markdown(f'<div class="insight-box">{md_to_html(SensitivityAnalysis.describe(sens_res))}</div>', unsafe_allow_html=True)
+                st.dataframe(sens_res['tornado'].drop(columns="影響幅度").style.format(
+                    {"低值": "{:,.2f}", "高值": "{:,.2f}", "低值總損失": "${:,.0f}", "高值總損失": "${:,.0f}"}), use_container_width=True, hide_index=True)
+                st.plotly_chart(figs_res['tornado'], use_container_width=True)
+                st.plotly_chart(figs_res['heatmap'], use_container_width=True)
+
+            st.header("7. 參數模擬 (What-if)")
+            st.caption("調整參數即時試算各群組損失；與上方報告的差額顯示於數字下方，不影響報告內容")
+            render_what_if(edited_df, params, input_key, summary_res, lambda: inc.process(edited_df, delta))
+
+    render_timing_panel(timer)
+
+def main():
+    # 偵錯模式關閉時所有 span 皆為共用的空 context，不記錄任何資料；記憶體剖析僅在勾選時啟動 tracemalloc
+    debug = st.sidebar.checkbox("🛠️ 效能偵錯模式 (顯示各階段耗時)")
+    memory = debug and st.sidebar.checkbox("記憶體剖析 (tracemalloc，執行會明顯變慢)")
+    timer = StageTimer(enabled=debug, memory=memory)
+    try: run_app(timer)
+    finally: timer.close()
+
 if __name__ == "__main__":
     main()
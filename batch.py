@@ -0,0 +1,153 @@
+# 批次命令列：不啟動 Streamlit，直接以分析核心產生 Word 報告 (可供 cron 排程)
+#   python batch.py 報表.xlsx --out-dir reports --per-plant
+#   python batch.py a.csv b.parquet --config params.json --elec-price 3.8
+#   python batch.py data/*.csv --workers 8   (多個行程平行產生，輸出目錄附 manifest.json)
+#   python batch.py daily.csv --history history.sqlite   (清理後明細同時存入歷史資料庫)
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from engine import DataEngine, AnalysisPipeline, ReportEngine, ResultCache, FigureRasterizer, ImageCache, HistoryStore
+
+DEFAULT_PARAMS = {'elec_price': 3.5, 'target_oee': 85.0, 'product_margin': 10.0}
+
+def load_params(args):
+    params = dict(DEFAULT_PARAMS)
+    if args.config:
+        with open(args.config, encoding='utf-8') as f: config = json.load(f)
+        params.update({k: float(v) for k, v in config.items() if k in DEFAULT_PARAMS})
+    # 命令列參數優先於設定檔
+    for key in DEFAULT_PARAMS:
+        value = getattr(args, key)
+        if value is not None: params[key] = value
+    return params
+
+def split_input(df, per_plant):
+    """回傳 [(廠別, 資料)]；per_plant 時依廠別各自成一份報告，否則廠別為 None"""
+    for user_col, sys_col in DataEngine.RENAME_MAP.items():
+        if user_col in df.columns: df = df.rename(columns={user_col: sys_col})
+    if not per_plant or "廠別" not in df.columns: return [(None, df)]
+    return [(str(plant), part.reset_index(drop=True)) for plant, part in df.groupby("廠別", sort=True)]
+
+def safe_filename(text):
+    # 廠別等資料值放進檔名前，替換路徑分隔與 Windows 不允許的字元
+    return re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", text).strip(" .") or "_"
+
+def output_path(out_dir, name, used):
+    """不同輸入檔的檔名相同 (a/daily.csv 與 b/daily.csv、daily.csv 與 daily.xlsx) 時依序加上 _2、_3，避免互相覆寫"""
+    candidate, n = name, 1
+    while candidate.lower() in used:
+        n += 1
+        candidate = f"{name}_{n}"
+    used.add(candidate.lower())
+    return os.path.join(out_dir, f"{candidate}.docx")
+
+def build_jobs(args):
+    """整理工作清單；依廠別拆分時由主行程讀檔一次再分送各分區，否則由工作行程各自讀檔"""
+    jobs, failed, used = [], [], set()
+    for path in args.inputs:
+        stem = safe_filename(os.path.splitext(os.path.basename(path))[0])
+        if not args.per_plant:
+            jobs.append({'input': path, 'plant': None, 'output': output_path(args.out_dir, stem, used), 'data': None})
+            continue
+        try: parts = split_input(DataEngine.read_file(path, path, args.sheets), True)
+        except Exception as e:
+            failed.append({'input': path, 'plant': None, 'output': None, 'status': 'failed',
+                           'error': f"檔案讀取失敗 ({e})", 'rows': 0, 'seconds': 0.0})
+            continue
+        for plant, df in parts:
+            name = stem if plant is None else f"{stem}_{safe_filename(plant)}"
+            jobs.append({'input': path, 'plant': plant, 'output': output_path(args.out_dir, name, used), 'data': df})
+    return jobs, failed
+
+# 每個工作行程建立一個圖表轉檔器，行程內所有工作共用 (kaleido 行程啟動成本高)
+_rasterizer = None
+
+def _init_worker(image_cache_dir, raster_threads):
+    global _rasterizer
+    _rasterizer = FigureRasterizer(max_workers=raster_threads, cache=ImageCache(cache_dir=image_cache_dir))
+
+def run_job(job, params, sheets, history=None):
+    """產生單一報告，回傳 manifest 紀錄 (含耗時與筆數)"""
+    start = time.perf_counter()
+    record = {'input': job['input'], 'plant': job['plant'], 'output': job['output'], 'status': 'ok', 'error': None, 'rows': 0}
+    try:
+        df = job['data']
+        if df is None: df = split_input(DataEngine.read_file(job['input'], job['input'], sheets), False)[0][1]
+        record['rows'] = len(df)
+        # 單次工作內的階段快取，讓敏感度分析沿用同一份清理結果
+        cache, key = ResultCache(max_entries=64), AnalysisPipeline.fingerprint(df)
+        df_res, summary_res, scope_res, texts_res, figs_res = AnalysisPipeline.run(df, params, cache=cache, data_key=key)
+        if df_res is None or summary_res is None: raise ValueError(scope_res)
+        docx = ReportEngine.generate_docx(df_res, summary_res, texts_res, figs_res, scope_res, rasterizer=_rasterizer,
+                                          sensitivity=AnalysisPipeline.sensitivity(df, params, cache, key))
+        with open(job['output'], 'wb') as f: f.write(docx.getvalue())
+        if history: record['history_rows'] = HistoryStore(history).append(df_res, key, job['input'])
+    except Exception as e:
+        record.update(status='failed', error=str(e))
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    return record
+
+def run_jobs(jobs, params, args):
+    if args.workers <= 1:
+        _init_worker(args.image_cache_dir, 4)
+        for job in jobs: yield run_job(job, params, args.sheets, args.history)
+        return
+    # 多行程時每個行程只開一個 kaleido 轉檔執行緒，避免同時啟動過多瀏覽器行程
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(args.image_cache_dir, 1)) as pool:
+        futures = {pool.submit(run_job, job, params, args.sheets, args.history): job for job in jobs}
+        for fut in as_completed(futures):
+            # 工作行程異常結束 (例如記憶體不足被終止) 時行程池損毀，其餘未完成的工作也會拋出例外；
+            # 逐一記為失敗，已完成的工作仍寫入 manifest
+            try: yield fut.result()
+            except Exception as e:
+                job = futures[fut]
+                yield {'input': job['input'], 'plant': job['plant'], 'output': job['output'], 'status': 'failed',
+                       'error': f"工作行程異常結束 ({type(e).__name__}: {e})", 'rows': 0, 'seconds': 0.0}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生產效能報告批次產生器")
+    parser.add_argument("inputs", nargs="+", help="生產報表檔 (xlsx/csv/parquet/feather/arrow)")
+    parser.add_argument("--out-dir", default=".", help="報告輸出目錄 (預設為目前目錄)")
+    parser.add_argument("--config", help="JSON 參數檔，可含 elec_price、target_oee、product_margin")
+    parser.add_argument("--elec-price", dest="elec_price", type=float, help="電價 (元/度)")
+    parser.add_argument("--target-oee", dest="target_oee", type=float, help="目標 OEE (%%)")
+    parser.add_argument("--product-margin", dest="product_margin", type=float, help="獲利估算 (元/雙)")
+    parser.add_argument("--sheets", nargs="+", help="Excel 要讀取的工作表 (預設第一張)")
+    parser.add_argument("--per-plant", action="store_true", help="依廠別分別產生報告")
+    parser.add_argument("--workers", type=int, default=1, help="平行產生報告的行程數上限 (預設 1，不開行程池)")
+    parser.add_argument("--manifest", default="manifest.json", help="輸出目錄內的執行摘要檔名")
+    parser.add_argument("--history", default=os.environ.get("HISTORY_DB_PATH"), help="歷史資料庫 (SQLite) 路徑，指定時存入清理後明細")
+    parser.add_argument("--image-cache-dir", default=os.environ.get("REPORT_IMAGE_CACHE_DIR"), help="圖表 PNG 磁碟快取目錄")
+    args = parser.parse_args(argv)
+
+    params = load_params(args)
+    os.makedirs(args.out_dir, exist_ok=True)
+    start = time.perf_counter()
+    jobs, records = build_jobs(args)
+    for record in records: print(f"[失敗] {record['input']}: {record['error']}", file=sys.stderr)
+    for record in run_jobs(jobs, params, args):
+        name = record['input'] + (f" ({record['plant']})" if record['plant'] else "")
+        if record['status'] == 'ok': print(f"[完成] {record['output']}  {record['seconds']:.2f}s")
+        else: print(f"[失敗] {name}: {record['error']}", file=sys.stderr)
+        records.append(record)
+
+    failed = sum(r['status'] != 'ok' for r in records)
+    manifest = {
+        'params': params, 'workers': args.workers, 'wall_seconds': round(time.perf_counter() - start, 3),
+        'job_seconds': round(sum(r['seconds'] for r in records), 3),
+        'reports': len(records) - failed, 'failed': failed,
+        'jobs': sorted(records, key=lambda r: (r['input'], r['plant'] or "")),
+    }
+    with open(os.path.join(args.out_dir, args.manifest), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"共 {manifest['reports']} 份報告、{failed} 份失敗，總耗時 {manifest['wall_seconds']:.1f}s")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
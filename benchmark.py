@@ -0,0 +1,175 @@
+# 效能基準測試：以可重現的合成生產資料量測各引擎階段的耗時與記憶體峰值，輸出 JSON 供版本間比對
+#   python benchmark.py --sizes 1k 10k 100k --output bench.json
+#   python benchmark.py --sizes 1M --stages clean_and_process generate_narrative --baseline bench.json
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.graph_objects as go
+
+from engine import DataEngine, InsightEngine, VizEngine, ReportEngine, FigureRasterizer
+from batch import DEFAULT_PARAMS
+
+def generate_production_data(rows, plants=3, machines=None, days=365, noise=0.1, bad_rows=0.01, seed=0):
+    """產生 rows 筆逐日機台紀錄 (與上傳報表相同的原始欄位)。未指定機台數時固定天數、依筆數推算每廠機台數。
+    bad_rows 比例的列會是常見的髒資料：停機零產量、漏抄電表 (空值)、OEE 誤填為小數。"""
+    rng = np.random.default_rng(seed)
+    if machines is None: machines = max(1, -(-rows // (plants * days)))
+    else: days = max(1, -(-rows // (plants * machines)))
+    n_units = plants * machines
+    idx = np.arange(rows)
+    unit, day = idx % n_units, idx // n_units
+
+    # 每台機台有各自的基準效率、產能與單位能耗，逐日再加上雜訊
+    base_oee = rng.uniform(0.45, 0.92, n_units)
+    capacity = rng.uniform(1500, 6000, n_units)
+    kwh_per_pair = rng.uniform(0.0015, 0.004, n_units)
+    oee = np.clip(base_oee[unit] * (1 + noise * rng.standard_normal(rows)), 0.05, 1.0)
+    prod = np.clip(capacity[unit] * oee * (1 + noise * rng.standard_normal(rows)), 0, None)
+    energy = np.clip(prod * kwh_per_pair[unit] * (1 + noise * rng.standard_normal(rows)), 0, None)
+    oee, prod, energy = np.round(oee * 100, 1), np.round(prod, 1), np.round(energy, 2)
+
+    bad = rng.choice(rows, size=int(rows * bad_rows), replace=False)
+    kind = rng.integers(0, 3, len(bad))
+    prod[bad[kind == 0]] = 0.0
+    energy[bad[kind == 1]] = np.nan
+    oee[bad[kind == 2]] = np.round(oee[bad[kind == 2]] / 100, 3)
+
+    plant_names = np.array([f"{chr(65 + p % 26)}{p // 26 or ''}廠" for p in range(plants)], dtype=object)
+    machine_ids = np.array([f"M{u:04d}" for u in range(n_units)], dtype=object)
+    dates = pd.date_range("2024-01-01", periods=days).strftime("%Y-%m-%d").to_numpy(dtype=object)
+    return pd.DataFrame({
+        "日期": dates[day], "廠別": plant_names[unit // machines], "機台編號": machine_ids[unit],
+        "OEE(%)": oee, "產量(雙)": prod, "用電量(kWh)": energy,
+    })
+
+def parse_size(text):
+    text = text.strip().lower()
+    scale = {'k': 1_000, 'm': 1_000_000}.get(text[-1], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+def build_stages(raw, params, rasterizer):
+    """依執行順序回傳 [(階段名稱, 函式)]；後面的階段使用前面階段的輸出 (只計算一次，不計入其他階段耗時)"""
+    df, summary, scope = DataEngine.clean_and_process(raw, params)
+    if df is None: raise ValueError(scope)
+    group_col = "廠別" if scope == "跨廠區分析" else "機台編號"
+    texts = InsightEngine.generate_narrative(df, summary, group_col, params)
+    trend, freq = DataEngine.rollup_trend(df, group_col)
+    figures = {
+        'rank': VizEngine.create_rank_chart(summary, group_col), 'cv': VizEngine.create_cv_chart(df, group_col),
+        'scatter': VizEngine.create_scatter_chart(df, group_col),
+        'dual': VizEngine.create_dual_axis_chart(trend, group_col, freq=freq),
+        'pie': VizEngine.create_pie_chart(summary, group_col), 'unit': VizEngine.create_unit_energy_chart(summary, group_col),
+    }
+    return [
+        ('clean_and_process', lambda: DataEngine.clean_and_process(raw, params)),
+        ('generate_narrative', lambda: InsightEngine.generate_narrative(df, summary, group_col, params)),
+        ('rollup_trend', lambda: DataEngine.rollup_trend(df, group_col)),
+        ('create_rank_chart', lambda: VizEngine.create_rank_chart(summary, group_col)),
+        ('create_cv_chart', lambda: VizEngine.create_cv_chart(df, group_col)),
+        ('create_scatter_chart', lambda: VizEngine.create_scatter_chart(df, group_col)),
+        ('create_dual_axis_chart', lambda: VizEngine.create_dual_axis_chart(trend, group_col, freq=freq)),
+        ('create_pie_chart', lambda: VizEngine.create_pie_chart(summary, group_col)),
+        ('create_unit_energy_chart', lambda: VizEngine.create_unit_energy_chart(summary, group_col)),
+        ('generate_docx', lambda: ReportEngine.generate_docx(df, summary, texts, figures, scope, rasterizer=rasterizer)),
+    ]
+
+def measure(func, repeats, memory):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        # 記憶體峰值另跑一次量測，tracemalloc 的額外負擔不計入耗時
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'seconds_min': round(min(times), 6), 'seconds_median': round(float(np.median(times)), 6),
+            'repeats': repeats, 'peak_bytes': peak}
+
+def environment():
+    try: commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception: commit = None
+    return {'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'pandas': pd.__version__, 'numpy': np.__version__, 'plotly': plotly.__version__}
+
+def compare(results, baseline_path, threshold):
+    """與先前結果比對 seconds_min，回傳超過門檻的退步項目"""
+    with open(baseline_path, encoding='utf-8') as f: baseline = json.load(f)
+    old = {(r['rows'], r['stage']): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        prev = old.get((r['rows'], r['stage']))
+        if prev is None or not prev['seconds_min']: continue
+        ratio = r['seconds_min'] / prev['seconds_min']
+        flag = "  ⚠ 退步" if ratio > threshold else ""
+        print(f"  {r['rows']:>10,} {r['stage']:<26} {prev['seconds_min']:>9.4f}s → {r['seconds_min']:>9.4f}s  x{ratio:.2f}{flag}")
+        if ratio > threshold: regressions.append((r['rows'], r['stage'], ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生產效能分析引擎基準測試")
+    parser.add_argument("--sizes", nargs="+", default=["1k", "10k", "100k"], help="資料筆數 (可用 k/M 後綴，例如 1k 1M 10M)")
+    parser.add_argument("--plants", type=int, default=3, help="廠別數")
+    parser.add_argument("--machines", type=int, help="每廠機台數 (預設依筆數與天數推算)")
+    parser.add_argument("--days", type=int, default=365, help="天數 (指定機台數時改依筆數推算)")
+    parser.add_argument("--noise", type=float, default=0.1, help="逐日雜訊的相對標準差")
+    parser.add_argument("--bad-rows", type=float, default=0.01, help="髒資料列比例")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", help="只量測指定階段 (預設全部)")
+    parser.add_argument("--repeats", type=int, default=3, help="每個階段重複次數，取最小值")
+    parser.add_argument("--no-memory", action="store_true", help="略過 tracemalloc 記憶體峰值量測")
+    parser.add_argument("--output", default="benchmark.json", help="結果 JSON 輸出路徑")
+    parser.add_argument("--baseline", help="與先前的結果 JSON 比對")
+    parser.add_argument("--threshold", type=float, default=1.25, help="耗時超過基準幾倍視為退步")
+    args = parser.parse_args(argv)
+
+    params = dict(DEFAULT_PARAMS)
+    rasterizer = None
+    if not args.stages or 'generate_docx' in args.stages:
+        # 不加快取以量測實際轉檔成本；先轉一張空白圖啟動 Kaleido，避免啟動時間算進第一次量測
+        rasterizer = FigureRasterizer()
+        rasterizer.render_all({'warmup': go.Figure()})
+    results = []
+    for size in args.sizes:
+        rows = parse_size(size)
+        raw = generate_production_data(rows, args.plants, args.machines, args.days, args.noise, args.bad_rows, args.seed)
+        stages = build_stages(raw, params, rasterizer)
+        if args.stages: stages = [(name, func) for name, func in stages if name in args.stages]
+        print(f"{rows:,} 筆")
+        for name, func in stages:
+            record = {'rows': rows, 'stage': name, **measure(func, args.repeats, not args.no_memory)}
+            results.append(record)
+            peak = f"{record['peak_bytes'] / 1024 ** 2:>9.1f} MB" if record['peak_bytes'] is not None else ""
+            print(f"  {name:<26} {record['seconds_min']:>9.4f}s {peak}")
+
+    config = {k: getattr(args, k) for k in ('plants', 'machines', 'days', 'noise', 'bad_rows', 'seed', 'repeats')}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'config': config, 'params': params, 'results': results},
+                  f, ensure_ascii=False, indent=2)
+    print(f"結果已寫入 {args.output}")
+
+    if args.baseline:
+        print(f"與 {args.baseline} 比對 (門檻 x{args.threshold}):")
+        regressions = compare(results, args.baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} 個階段退步超過門檻", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
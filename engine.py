@@ -0,0 +1,1598 @@
+# 分析核心：資料處理、洞察、圖表與報告引擎 (不依賴 Streamlit，可供網頁介面與批次命令列共用)
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+import numpy as np
+from io import BytesIO
+from docx import Document
+from docx.shared import Inches, Pt, RGBColor
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+import re
+import os
+import copy
+import hashlib
+import pickle
+import threading
+import time
+import json
+import sqlite3
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import plotly.io as pio
+import openpyxl
+
+try:
+    from kaleido.scopes.plotly import PlotlyScope
+except ImportError:
+    PlotlyScope = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.feather as pa_feather
+except ImportError:
+    pa = None
+
+try:
+    import python_calamine
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = None
+
+# ==========================================
+# 1. Helper Functions
+# ==========================================
+def md_to_html(text):
+    if not isinstance(text, str): return str(text)
+    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
+    text = text.replace('\n', '<br>')
+    return text
+
+def clean_text_for_word(text):
+    if not isinstance(text, str): return str(text)
+    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+    text = re.sub(r'<b>(.*?)</b>', r'\1', text)
+    text = re.sub(r'<br>', '\n', text)
+    text = re.sub(r'🔴|🟡|🟢', '', text)
+    return text.strip()
+
+# ==========================================
+# 2. Data Engine
+# ==========================================
+class DataEngine:
+    # 向量化計算核心：以遮罩除法取代逐列 apply，結果與原 lambda 逐位元相同
+    @staticmethod
+    def _safe_ratio(num, den):
+        num = num.to_numpy(dtype="float64")
+        den = den.to_numpy(dtype="float64")
+        out = np.zeros(len(num), dtype="float64")
+        np.divide(num, den, out=out, where=den > 0)
+        return out
+
+    @staticmethod
+    def compute_metrics(df):
+        oee_raw = df["OEE_RAW"].to_numpy(dtype="float64")
+        df["OEE"] = np.where(oee_raw > 1.0, oee_raw / 100.0, oee_raw)
+        df["單位能耗"] = DataEngine._safe_ratio(df["耗電量"], df["產量"])
+        return df
+
+    @staticmethod
+    def best_unit_energy(df):
+        best_energy = df.loc[df["單位能耗"] > 0, "單位能耗"].min()
+        if pd.isna(best_energy): best_energy = 0
+        return best_energy
+
+    @staticmethod
+    def compute_losses(df, best_energy, params):
+        unit = df["單位能耗"].to_numpy(dtype="float64")
+        prod = df["產量"].to_numpy(dtype="float64")
+        oee = df["OEE"].to_numpy(dtype="float64")
+        target = params['target_oee'] / 100
+
+        # max(0, x)：NaN 與 -0.0 皆歸零，與原本 Python max 行為一致
+        energy_loss = (unit - best_energy) * prod * params['elec_price']
+        df["能源損失"] = np.where(energy_loss > 0, energy_loss, 0.0)
+
+        in_gap = (oee > 0) & (oee < target)
+        safe_oee = np.where(in_gap, oee, 1.0)
+        df["產能損失機會成本"] = np.where(in_gap, (target - safe_oee) / safe_oee * prod * params['product_margin'], 0.0)
+        return df
+
+    RENAME_MAP = {"用電量(kWh)": "耗電量", "產量(雙)": "產量", "OEE(%)": "OEE_RAW", "設備": "機台編號", "機台": "機台編號"}
+    REQUIRED_COLS = ["機台編號", "耗電量", "產量", "OEE_RAW"]
+    CATEGORY_COLS = ["機台編號", "廠別"]
+    FLOAT32_COLS = ["耗電量", "產量", "OEE_RAW"]
+
+    # 常見日期格式；以樣本推斷後用精確格式解析，避免逐筆猜格式
+    DATE_FORMATS = ["%Y-%m-%d", "%Y/%m/%d", "%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M",
+                    "%Y/%m/%d %H:%M", "%Y%m%d", "%Y.%m.%d", "%m/%d/%Y", "%d/%m/%Y"]
+
+    @staticmethod
+    def infer_date_format(series, sample_size=200):
+        values = series.dropna()
+        if values.empty: return None
+        # 從頭到尾等距取樣，避免只看到檔案開頭的格式
+        sample = values.iloc[np.linspace(0, len(values) - 1, min(sample_size, len(values))).astype(int)]
+        if not all(isinstance(v, str) for v in sample): return None
+        for fmt in DataEngine.DATE_FORMATS:
+            try:
+                pd.to_datetime(sample, format=fmt)
+                return fmt
+            except (ValueError, TypeError):
+                continue
+        return None
+
+    @staticmethod
+    def parse_dates(series):
+        """日期欄轉為 datetime64。字串欄先以樣本推斷格式，只對不重複的值用精確格式解析再展開回各列；
+        樣本外格式不符的值才退回逐值解析"""
+        if pd.api.types.is_datetime64_any_dtype(series): return series
+        fmt = DataEngine.infer_date_format(series)
+        if fmt is None: return pd.to_datetime(series, errors='coerce', format="mixed")
+        codes, uniques = pd.factorize(series)
+        uniques = pd.Series(uniques)
+        parsed = pd.to_datetime(uniques, format=fmt, errors='coerce')
+        bad = parsed.isna()
+        if bad.any(): parsed[bad] = pd.to_datetime(uniques[bad], errors='coerce', format="mixed")
+        # 空值的 code 為 -1，剛好對應到尾端補上的 NaT
+        values = np.append(parsed.to_numpy(), np.datetime64("NaT"))
+        return pd.Series(values[codes], index=series.index, name=series.name)
+
+    @staticmethod
+    def fits_float32(series):
+        """數值欄轉為 float32 再轉回是否完全不變 (例如整數產量)；只有無損時才降型，後續損失計算才會與原始值逐位元相同"""
+        v64 = series.to_numpy(dtype="float64")
+        return np.array_equal(v64.astype("float32").astype("float64"), v64, equal_nan=True)
+
+    @staticmethod
+    def compact_dtypes(df, downcast=True):
+        """機台/廠別轉為 category；原始數值欄可無損轉為 float32 時降為 float32 (downcast=False 時略過)。
+        衍生欄位維持 float64，加總類計算請先轉回 float64。"""
+        for col in DataEngine.CATEGORY_COLS:
+            if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype("category")
+        if not downcast: return df
+        for col in DataEngine.FLOAT32_COLS:
+            if col in df.columns and pd.api.types.is_numeric_dtype(df[col]) and df[col].dtype != "float32":
+                if DataEngine.fits_float32(df[col]): df[col] = df[col].to_numpy(dtype="float64").astype("float32")
+        return df
+
+    @staticmethod
+    def plain(series):
+        """category 欄位 (Series 或 Index) 還原成原本的值型別 (供繪圖與顯示使用)"""
+        if isinstance(series.dtype, pd.CategoricalDtype): return series.astype(series.dtype.categories.dtype)
+        return series
+
+    @staticmethod
+    def union_categories(a, b):
+        # 兩邊 category 欄位對齊類別，concat / loc 寫入後才能維持 category 型別
+        for col in DataEngine.CATEGORY_COLS:
+            if col in a.columns and col in b.columns and isinstance(a[col].dtype, pd.CategoricalDtype) \
+                    and isinstance(b[col].dtype, pd.CategoricalDtype):
+                cats = a[col].cat.categories.union(b[col].cat.categories)
+                a[col] = a[col].cat.set_categories(cats)
+                b[col] = b[col].cat.set_categories(cats)
+
+    @staticmethod
+    def memory_report(df_raw, df):
+        """比較原始輸入欄位與精簡後同一批欄位的記憶體用量 (bytes)"""
+        cols = [DataEngine.RENAME_MAP.get(c, c) for c in df_raw.columns]
+        cols = [c for c in dict.fromkeys(cols) if c in df.columns]
+        return int(df_raw.memory_usage(deep=True, index=False).sum()), int(df[cols].memory_usage(deep=True, index=False).sum())
+
+    @staticmethod
+    def prepare(df, downcast=True):
+        """欄位更名、必要欄位檢查、日期轉換與基礎指標；回傳 (df, 錯誤訊息)。
+        downcast=False 時原始數值欄保留 float64 (由呼叫端依整欄決定是否降為 float32)"""
+        for user_col, sys_col in DataEngine.RENAME_MAP.items():
+            if user_col in df.columns: df = df.rename(columns={user_col: sys_col})
+
+        missing = [c for c in DataEngine.REQUIRED_COLS if c not in df.columns]
+        if missing: return None, f"資料表缺少必要欄位: {missing}"
+
+        if "日期" in df.columns:
+            df["日期"] = DataEngine.parse_dates(df["日期"])
+            if df["日期"].isnull().any(): return None, "日期格式錯誤"
+
+        if "廠別" not in df.columns: df["廠別"] = "匯入廠區"
+        # 先以完整精度計算衍生欄位，再精簡原始欄位型別
+        return DataEngine.compact_dtypes(DataEngine.compute_metrics(df), downcast), None
+
+    # Excel 僅讀取分析會用到的欄位
+    EXCEL_COLS = set(RENAME_MAP) | set(RENAME_MAP.values()) | {"日期", "廠別"}
+
+    @staticmethod
+    def read_file(source, name, sheets=None):
+        ext = os.path.splitext(name)[1].lower()
+        if ext == '.csv': return pd.read_csv(source)
+        if ext == '.parquet': return pd.read_parquet(source)
+        if ext in ('.feather', '.arrow', '.ipc'): return pd.read_feather(source)
+        if hasattr(source, 'getvalue'): source = source.getvalue()
+        return DataEngine.read_excel_sheets(source, sheets)
+
+    @staticmethod
+    def _excel_source(source):
+        # bytes 需為每個執行緒各自包一個 BytesIO，路徑則可直接共用
+        return BytesIO(source) if isinstance(source, bytes) else source
+
+    @staticmethod
+    def list_sheets(source):
+        wb = openpyxl.load_workbook(DataEngine._excel_source(source), read_only=True)
+        try: return wb.sheetnames
+        finally: wb.close()
+
+    @staticmethod
+    def read_excel_sheet(source, sheet):
+        if EXCEL_ENGINE:
+            return pd.read_excel(DataEngine._excel_source(source), sheet_name=sheet, engine=EXCEL_ENGINE,
+                                 usecols=lambda c: c in DataEngine.EXCEL_COLS)
+        # openpyxl read_only 模式逐列串流，不會將整本活頁簿載入記憶體
+        wb = openpyxl.load_workbook(DataEngine._excel_source(source), read_only=True, data_only=True)
+        try:
+            rows = wb[sheet].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None: return pd.DataFrame()
+            keep = [i for i, h in enumerate(header) if h in DataEngine.EXCEL_COLS]
+            records = [[row[i] if i < len(row) else None for i in keep]
+                       for row in rows if row and any(v is not None for v in row)]
+            return pd.DataFrame(records, columns=[header[i] for i in keep])
+        finally:
+            wb.close()
+
+    @staticmethod
+    def read_excel_sheets(source, sheets=None, max_workers=4):
+        if not sheets: sheets = DataEngine.list_sheets(source)[:1]
+        if len(sheets) == 1: return DataEngine.read_excel_sheet(source, sheets[0])
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(sheets))) as pool:
+            frames = list(pool.map(lambda sheet: DataEngine.read_excel_sheet(source, sheet), sheets))
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def iter_csv_chunks(source, block_size=64 * 1024 ** 2, chunksize=500_000):
+        """分塊讀取 CSV；有 pyarrow 時使用其串流讀取器，否則退回 pandas chunksize"""
+        if pa is None:
+            yield from pd.read_csv(source, chunksize=chunksize)
+            return
+        # 數值欄位固定為 float64，避免首個區塊推斷成整數後在後續區塊型別衝突
+        numeric = {c: pa.float64() for c in ["用電量(kWh)", "產量(雙)", "OEE(%)", "耗電量", "產量", "OEE_RAW"]}
+        text = {c: pa.string() for c in ["日期", "廠別", "機台編號", "設備", "機台"]}
+        reader = pa_csv.open_csv(
+            source, read_options=pa_csv.ReadOptions(block_size=block_size),
+            # 空白文字欄視為空值，與 pd.read_csv 相同 (否則空字串會自成一個廠別/機台)
+            convert_options=pa_csv.ConvertOptions(column_types={**numeric, **text}, strings_can_be_null=True)
+        )
+        for batch in reader:
+            yield batch.to_pandas()
+
+    @staticmethod
+    def process_csv_stream(source, params):
+        try:
+            agg = StreamingAggregator(params)
+            for chunk in DataEngine.iter_csv_chunks(source):
+                chunk, err = DataEngine.prepare(chunk)
+                if err: return None, None, err
+                agg.add_chunk(chunk)
+            if agg.rows == 0: return None, None, "檔案沒有資料"
+            return agg.finalize()
+        except Exception as e:
+            return None, None, str(e)
+
+    # 趨勢圖每個群組最多的時間桶數；依日期跨度由日 → 週 → 月 依序放大桶寬
+    TREND_MAX_BUCKETS = 90
+
+    @staticmethod
+    def rollup_trend(df, group_col, max_buckets=None):
+        """將逐日資料依群組彙總到日/週/月時間桶 (產量、耗電量、總損失加總，OEE 取平均)；回傳 (彙總表, 桶別)"""
+        if "日期" not in df.columns: return df, "D"
+        max_buckets = max_buckets or DataEngine.TREND_MAX_BUCKETS
+        dates = DataEngine.parse_dates(df["日期"])
+        span_days = (dates.max() - dates.min()).days + 1
+        if span_days <= max_buckets: freq, bucket = "D", dates.dt.normalize()
+        elif span_days / 7 <= max_buckets: freq, bucket = "W", dates.dt.to_period("W").dt.start_time
+        else: freq, bucket = "M", dates.dt.to_period("M").dt.start_time
+
+        values = pd.DataFrame({
+            "產量": df["產量"].astype("float64"), "耗電量": df["耗電量"].astype("float64"),
+            "OEE": df["OEE"], "總損失": df["總損失"]
+        })
+        grouped = values.groupby([bucket.rename("日期"), df[group_col]], sort=False, observed=True)
+        # min_count=1：整個時間桶都沒有讀值 (例如漏抄電表) 時保留 NaN，圖上呈現為缺口而非 0
+        rolled = grouped[["產量", "耗電量", "總損失"]].sum(min_count=1)
+        rolled.insert(2, "OEE", grouped["OEE"].mean())
+        rolled = rolled.reset_index()
+        rolled[group_col] = DataEngine.plain(rolled[group_col])
+        return rolled, freq
+
+    @staticmethod
+    def clean_and_process(df_raw, params, timer=None):
+        timer = timer or StageTimer.DISABLED
+        try:
+            with timer.span("複製輸入資料"): df = df_raw.copy()
+            with timer.span("欄位轉換與指標"): df, err = DataEngine.prepare(df)
+            if err: return None, None, err
+
+            with timer.span("損失計算"):
+                best_energy = DataEngine.best_unit_energy(df)
+                df = DataEngine.compute_losses(df, best_energy, params)
+                df["總損失"] = df["能源損失"] + df["產能損失機會成本"]
+            
+            group_col = "廠別" if df["廠別"].nunique() > 1 else "機台編號"
+            analysis_scope = "跨廠區分析" if group_col == "廠別" else "單廠設備分析"
+            
+            with timer.span("群組彙總"): summary_agg = DataEngine.summarize(df, group_col)
+            
+            return df, summary_agg, analysis_scope
+        except Exception as e:
+            return None, None, str(e)
+
+    LOSS_COLS = ["能源損失", "產能損失機會成本", "總損失"]
+
+    @staticmethod
+    def summarize(df, group_col, with_losses=True):
+        """依群組彙總績效總表 (OEE 平均，其餘加總)；with_losses=False 時只彙總與參數無關的欄位"""
+        agg = {"OEE": "mean", "產量": "sum", "耗電量": "sum"}
+        if with_losses: agg.update({col: "sum" for col in DataEngine.LOSS_COLS})
+        summary_agg = df.astype({"產量": "float64", "耗電量": "float64"}).groupby(group_col, observed=True).agg(agg).reset_index()
+        summary_agg[group_col] = DataEngine.plain(summary_agg[group_col])
+        
+        summary_agg["平均單位能耗"] = DataEngine._safe_ratio(summary_agg["耗電量"], summary_agg["產量"])
+        return summary_agg.sort_values("OEE", ascending=False)
+
+class ColumnarCache:
+    """已解析上傳檔的 Arrow IPC 檔快取；以未壓縮格式寫入，再次讀取時直接 memory-map，不需重新解析。
+    檔案總大小或個數超過上限時，依最後使用時間 (讀取時更新 mtime) 刪除最久未用的檔案。"""
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, max_entries=64):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.cache_dir, f"{digest}.arrow")
+
+    def load(self, digest):
+        path = self.path(digest)
+        if pa is None or not os.path.exists(path): return None
+        try: os.utime(path)
+        except OSError: pass
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all().to_pandas(split_blocks=True)
+
+    def save(self, digest, df):
+        if pa is None: return False
+        path = self.path(digest)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            pa_feather.write_feather(df, tmp_path, compression='uncompressed')
+            os.replace(tmp_path, path)
+            self.evict()
+            return True
+        except Exception:
+            # 混合型別的物件欄位無法轉成 Arrow，略過快取即可
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            return False
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".arrow"): continue
+            try: stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError: continue  # 其他行程剛刪除
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and (total > self.max_bytes or len(entries) > self.max_entries):
+            _, size, name = entries.pop(0)
+            # 仍被 memory-map 使用中 (Windows) 或已被其他行程刪除時略過
+            try: os.remove(os.path.join(self.cache_dir, name))
+            except OSError: continue
+            total -= size
+
+class HistoryStore:
+    """清理後明細的本機歷史資料庫 (SQLite 單一檔案)。
+    每筆紀錄以 (日期, 廠別, 機台編號, 序號) 為唯一鍵 (序號為同一天同一機台的第幾筆，例如多個班別)，
+    重複存入 (例如從資料庫載回後再存) 時覆寫同一筆而不會重複計算；
+    損失欄位取決於當下參數與比較範圍，不存入資料庫，載回後依當時參數重新計算。
+    日期以 epoch 秒存放，唯一鍵索引以日期開頭，另建 (廠別, 日期)、(機台編號, 日期) 索引，依期間與機台查詢時不需掃描整張表。"""
+    COLUMNS = {"日期": "INTEGER NOT NULL", "廠別": "TEXT", "機台編號": "TEXT", "OEE_RAW": "REAL", "產量": "REAL", "耗電量": "REAL",
+               "OEE": "REAL", "單位能耗": "REAL"}
+    # 唯一鍵；空白的廠別/機台以空字串比對 (SQLite 的 UNIQUE 視每個 NULL 為不同值)
+    KEY = '"日期", IFNULL("廠別", \'\'), IFNULL("機台編號", \'\'), "序號"'
+    # 載回分析用的原始欄位 (其餘欄位會依當下參數重新計算)
+    INPUT_COLS = ["日期", "廠別", "機台編號", "OEE_RAW", "產量", "耗電量"]
+
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        with self._connect() as conn:
+            cols = ", ".join(f'"{c}" {t}' for c, t in HistoryStore.COLUMNS.items())
+            conn.executescript(f"""
+                CREATE TABLE IF NOT EXISTS batches (id INTEGER PRIMARY KEY, digest TEXT UNIQUE, source TEXT,
+                    imported_at TEXT, rows INTEGER);
+                CREATE TABLE IF NOT EXISTS records (batch_id INTEGER REFERENCES batches(id), "序號" INTEGER NOT NULL, {cols});
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_records_key ON records ({HistoryStore.KEY});
+                CREATE INDEX IF NOT EXISTS idx_records_plant_date ON records ("廠別", "日期");
+                CREATE INDEX IF NOT EXISTS idx_records_machine_date ON records ("機台編號", "日期");
+                CREATE INDEX IF NOT EXISTS idx_records_batch ON records (batch_id);
+            """)
+
+    @contextmanager
+    def _connect(self):
+        # 每次操作各開一個連線，可供多個 session 執行緒或批次行程同時使用；WAL 模式下寫入時仍可讀取
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn: yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _names(columns):
+        return ", ".join(f'"{c}"' for c in columns)
+
+    @staticmethod
+    def _epoch(dates):
+        values = DataEngine.parse_dates(dates).to_numpy(dtype="datetime64[s]")
+        out = values.astype("int64").astype(object)
+        out[np.isnat(values)] = None
+        return out
+
+    def append(self, df, digest, source=""):
+        """存入 clean_and_process 的輸出，回傳新增筆數。同一份資料 (digest 相同) 已存入時直接略過；
+        (日期, 廠別, 機台編號, 序號) 已存在的列以本次的值覆寫並歸入本次批次"""
+        if "日期" not in df.columns: raise ValueError("存入歷史資料庫需要日期欄")
+        keys = [df[c] for c in ["日期", "廠別", "機台編號"] if c in df.columns]
+        columns = {"序號": df.groupby(keys, dropna=False, observed=True, sort=False).cumcount().tolist()}
+        for col in HistoryStore.COLUMNS:
+            if col not in df.columns: columns[col] = [None] * len(df)
+            elif col == "日期": columns[col] = HistoryStore._epoch(df[col])
+            elif col in DataEngine.CATEGORY_COLS: columns[col] = DataEngine.plain(df[col]).astype(object).where(df[col].notna(), None).tolist()
+            # NaN 寫入 SQLite 即為 NULL
+            else: columns[col] = df[col].to_numpy(dtype="float64").tolist()
+        with self._connect() as conn:
+            if conn.execute("SELECT 1 FROM batches WHERE digest = ?", (digest,)).fetchone(): return 0
+            batch_id = conn.execute(
+                "INSERT INTO batches (digest, source, imported_at, rows) VALUES (?, ?, ?, ?)",
+                (digest, source, pd.Timestamp.now().isoformat(timespec='seconds'), len(df))
+            ).lastrowid
+            before = conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+            updates = ", ".join(f'"{c}" = excluded."{c}"' for c in ["batch_id", *HistoryStore.COLUMNS])
+            conn.executemany(f"INSERT INTO records (batch_id, {HistoryStore._names(columns)}) "
+                             f"VALUES (?, {', '.join('?' * len(columns))}) "
+                             f"ON CONFLICT ({HistoryStore.KEY}) DO UPDATE SET {updates}",
+                             zip([batch_id] * len(df), *columns.values()))
+            return conn.execute("SELECT COUNT(*) FROM records").fetchone()[0] - before
+
+    def query(self, start=None, end=None, plants=None, machines=None, columns=None):
+        """依日期區間 (含起訖日)、廠別與機台清單查詢明細，回傳 DataFrame；未給的條件不篩選"""
+        columns = columns or list(HistoryStore.COLUMNS)
+        where, args = [], []
+        if start is not None:
+            where.append('"日期" >= ?')
+            args.append(int(pd.Timestamp(start).normalize().timestamp()))
+        if end is not None:
+            where.append('"日期" < ?')
+            args.append(int((pd.Timestamp(end).normalize() + pd.Timedelta(days=1)).timestamp()))
+        for col, values in (("廠別", plants), ("機台編號", machines)):
+            if values:
+                where.append(f'"{col}" IN ({", ".join("?" * len(values))})')
+                args.extend(str(v) for v in values)
+        sql = f"SELECT {HistoryStore._names(columns)} FROM records"
+        if where: sql += " WHERE " + " AND ".join(where)
+        with self._connect() as conn:
+            # 依唯一鍵排序：同日同機台的多筆維持原本順序，載回後再存入時序號對應到同一筆
+            df = pd.read_sql_query(sql + ' ORDER BY "日期", "廠別", "機台編號", "序號"', conn, params=args)
+        if "日期" in df.columns: df["日期"] = pd.to_datetime(df["日期"], unit="s")
+        return df
+
+    def catalog(self):
+        """資料庫內容概況：日期範圍、廠別與機台清單 (皆由索引取得)"""
+        with self._connect() as conn:
+            lo, hi = conn.execute('SELECT MIN("日期"), MAX("日期") FROM records').fetchone()
+            plants = [r[0] for r in conn.execute('SELECT DISTINCT "廠別" FROM records WHERE "廠別" IS NOT NULL ORDER BY 1')]
+            machines = [r[0] for r in conn.execute('SELECT DISTINCT "機台編號" FROM records WHERE "機台編號" IS NOT NULL ORDER BY 1')]
+        to_date = lambda v: None if v is None else pd.Timestamp(v, unit="s")
+        return {'date_min': to_date(lo), 'date_max': to_date(hi), 'plants': plants, 'machines': machines}
+
+    def batches(self):
+        with self._connect() as conn:
+            return pd.read_sql_query("SELECT id, source, imported_at, rows FROM batches ORDER BY id", conn)
+
+    def remove_batch(self, batch_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM records WHERE batch_id = ?", (batch_id,))
+            conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+
+class StreamingAggregator:
+    """分塊累積各 (廠別, 機台編號) 的加總、筆數與 OEE 平方和，以有限記憶體產生總表與 KPI。
+
+    能源損失取決於全域最佳單位能耗，讀完前無法逐列計算；因此僅累積單位能耗 > 0 列的耗電量與產量
+    (以及負產量列的產量)，於 finalize 時以 Σ(耗電量) - best × Σ(產量) 還原，結果與逐列計算僅有浮點誤差。
+    """
+    KEYS = ["廠別", "機台編號"]
+
+    def __init__(self, params):
+        self.params = params
+        self.rows = 0
+        self.best_energy = np.nan
+        self.date_min = self.date_max = None
+        self._acc = None
+
+    def _chunk_agg(self, df):
+        target = self.params['target_oee'] / 100
+        oee = df["OEE"].to_numpy(dtype="float64")
+        prod = df["產量"].to_numpy(dtype="float64")
+        energy = df["耗電量"].to_numpy(dtype="float64")
+        pos = df["單位能耗"].to_numpy() > 0
+        in_gap = (oee > 0) & (oee < target)
+        safe_oee = np.where(in_gap, oee, 1.0)
+        part = pd.DataFrame({
+            "n": np.ones(len(df), dtype="int64"),
+            "oee_sum": np.nan_to_num(oee), "oee_sq": np.nan_to_num(oee) ** 2, "oee_n": ~np.isnan(oee),
+            "產量": prod, "耗電量": energy,
+            "pos_energy": np.where(pos, energy, 0.0), "pos_prod": np.where(pos, prod, 0.0),
+            "neg_prod": np.where(prod < 0, prod, 0.0),
+            "產能損失機會成本": np.where(in_gap, (target - safe_oee) / safe_oee * prod * self.params['product_margin'], 0.0),
+        })
+        # 直接以原欄位 (可能是 category) 分組，只把彙總後的少量鍵值還原成原本的值型別，
+        # 鍵值與 clean_and_process 的總表、圖表一致 (例如數字機台編號不會變成字串)。
+        # 空白鍵值也要保留：只有最後選定的分組欄位為空白的列才排除 (見 finalize)，另一個欄位空白的列仍要計入
+        agg = part.groupby([df[k].array for k in self.KEYS], observed=True, dropna=False).sum()
+        levels, codes = [], []
+        for i in range(len(self.KEYS)):
+            # 以 codes 表示空白 (-1)，數字鍵值的層級維持整數型別
+            level_codes, uniques = pd.factorize(agg.index.get_level_values(i))
+            codes.append(level_codes)
+            levels.append(DataEngine.plain(uniques))
+        agg.index = pd.MultiIndex(levels=levels, codes=codes, names=self.KEYS)
+        return agg
+
+    def add_chunk(self, df):
+        chunk_agg = self._chunk_agg(df)
+        self._acc = chunk_agg if self._acc is None else self._acc.add(chunk_agg, fill_value=0)
+
+        self.best_energy = np.fmin(self.best_energy, df.loc[df["單位能耗"] > 0, "單位能耗"].min())
+        if "日期" in df.columns and len(df):
+            lo, hi = df["日期"].min(), df["日期"].max()
+            self.date_min = lo if self.date_min is None else min(self.date_min, lo)
+            self.date_max = hi if self.date_max is None else max(self.date_max, hi)
+        self.rows += len(df)
+
+    def remove_chunk(self, df):
+        """扣除先前加入的列 (供增量更新使用)；日期區間與最佳單位能耗由呼叫端自行維護"""
+        self._acc = self._acc.sub(self._chunk_agg(df), fill_value=0)
+        self.rows -= len(df)
+
+    def finalize(self):
+        best_energy = 0 if pd.isna(self.best_energy) else self.best_energy
+        energy_loss = lambda t: np.maximum(t["pos_energy"] - best_energy * (t["pos_prod"] + t["neg_prod"]), 0) * self.params['elec_price']
+        acc = self._acc[self._acc["n"] > 0]
+        group_col = "廠別" if acc.index.get_level_values("廠別").dropna().nunique() > 1 else "機台編號"
+        analysis_scope = "跨廠區分析" if group_col == "廠別" else "單廠設備分析"
+
+        # 與 clean_and_process 相同：只排除分組欄位空白的列
+        g = acc.groupby(level=group_col).sum()
+        g["能源損失"] = energy_loss(g)
+        g["總損失"] = g["能源損失"] + g["產能損失機會成本"]
+        g["OEE"] = g["oee_sum"] / g["oee_n"]
+        var = (g["oee_sq"] - g["oee_sum"] ** 2 / g["oee_n"]) / (g["oee_n"] - 1)
+        cv = np.sqrt(var.clip(lower=0)) / g["OEE"]
+
+        summary_agg = g[["OEE", "產量", "耗電量", "能源損失", "產能損失機會成本", "總損失"]].reset_index()
+        summary_agg["平均單位能耗"] = DataEngine._safe_ratio(summary_agg["耗電量"], summary_agg["產量"])
+        summary_agg = summary_agg.sort_values("OEE", ascending=False)
+
+        # KPI 與非串流的 generate_narrative 相同，涵蓋所有列 (含分組欄位空白的列)
+        total = acc.sum()
+        kpis = {
+            "rows": self.rows,
+            "avg_oee": total["oee_sum"] / total["oee_n"],
+            "total_loss": energy_loss(total) + total["產能損失機會成本"],
+            "cv": cv,
+            "date_min": self.date_min, "date_max": self.date_max,
+        }
+        return summary_agg, kpis, analysis_scope
+
+class IncrementalProcessor:
+    """依 st.data_editor 的增/刪/改差異，只重算受影響列的衍生欄位與群組累積值。
+
+    全域最佳單位能耗只有在持有最小值的列被修改或刪除時才全表重找；最小值改變時才重算全表能源損失。
+    原始資料改變時由呼叫端建立新的實例；只有參數改變時呼叫 set_params，下次處理時沿用已清理的資料只重算損失。
+    """
+    def __init__(self, base_df, params):
+        self.base = base_df
+        self.params = dict(params)
+        self.df = None
+        self.agg = None
+        self.best = 0
+        self.delta = None
+        self.added_labels = None
+        self.params_changed = False
+
+    def matches(self, base_df):
+        return self.base is base_df
+
+    def set_params(self, params):
+        if params == self.params: return
+        self.params = dict(params)
+        self.params_changed = True
+
+    def _refresh_losses(self):
+        # 淺複製後覆寫損失欄位，已交給快取的舊 DataFrame 不會被修改
+        self.df = self._with_losses(self.df.copy(deep=False), self.best)
+        self.agg = StreamingAggregator(self.params)
+        self.agg.add_chunk(self.df)
+        self.params_changed = False
+
+    def process(self, edited_df, delta, timer=None):
+        timer = timer or StageTimer.DISABLED
+        try:
+            if self.df is not None:
+                if self.params_changed:
+                    with timer.span("重算損失"): self._refresh_losses()
+                try: return self._apply(edited_df, delta, timer)
+                except Exception: pass  # 差異無法對應時退回全量重算
+            return self._full(edited_df, delta, timer)
+        except Exception as e:
+            self.df = None
+            return None, None, str(e)
+
+    def _with_losses(self, df, best_energy):
+        df = DataEngine.compute_losses(df, best_energy, self.params)
+        df["總損失"] = df["能源損失"] + df["產能損失機會成本"]
+        return df
+
+    @staticmethod
+    def _merge_best(a, b):
+        # best_unit_energy 以 0 表示沒有正值
+        if a > 0 and b > 0: return min(a, b)
+        return a if a > 0 else b
+
+    def _full(self, edited_df, delta, timer):
+        with timer.span("複製輸入資料"): df = edited_df.copy()
+        with timer.span("欄位轉換與指標"): df, err = DataEngine.prepare(df)
+        if err:
+            self.df = None
+            return None, None, err
+        with timer.span("損失計算"):
+            self.best = DataEngine.best_unit_energy(df)
+            self.df = self._with_losses(df, self.best)
+        with timer.span("群組彙總"):
+            self.agg = StreamingAggregator(self.params)
+            self.agg.add_chunk(self.df)
+        self.params_changed = False
+        self.added_labels = edited_df.index.difference(self.base.index)
+        self.delta = copy.deepcopy(delta)
+        return self._result()
+
+    def _apply(self, edited_df, delta, timer):
+        old_edit, new_edit = self.delta.get("edited_rows", {}), delta.get("edited_rows", {})
+        changed = {int(p) for p in set(old_edit) | set(new_edit) if old_edit.get(p) != new_edit.get(p)}
+        deleted_diff = {int(p) for p in set(self.delta.get("deleted_rows", [])) ^ set(delta.get("deleted_rows", []))}
+        added_changed = self.delta.get("added_rows") != delta.get("added_rows")
+        # 只有儲存格修改時列集合不變，可直接就地覆寫受影響列，省去重建索引
+        same_rows = not deleted_diff and not added_changed
+        touched = self.base.index[sorted(changed | deleted_diff)]
+
+        remove = self.df.index.intersection(touched)
+        add = edited_df.index.intersection(touched)
+        if added_changed:
+            remove = remove.union(self.added_labels)
+            self.added_labels = edited_df.index.difference(self.base.index)
+            add = add.union(self.added_labels)
+
+        removed = self.df.loc[remove]
+        if len(removed): self.agg.remove_chunk(removed)
+        # 先取得新物件再寫入欄位，已交給快取的舊 DataFrame 不會被修改
+        with timer.span("複製分析結果"): df = self.df.copy() if same_rows else self.df.drop(index=remove)
+
+        added = None
+        if len(add):
+            # 是否降為 float32 需依整欄決定：新值需要 float64 而既有欄位為 float32 時，
+            # 既有列的損失與累積值都是以 float32 計算的，改為全量重算才會與 clean_and_process 一致
+            added, err = DataEngine.prepare(edited_df.loc[add].copy(), downcast=False)
+            if err: raise ValueError(err)
+            for col in DataEngine.FLOAT32_COLS:
+                if col not in df.columns or df[col].dtype != "float32": continue
+                if not DataEngine.fits_float32(added[col]): return self._full(edited_df, delta, timer)
+                added[col] = added[col].to_numpy(dtype="float64").astype("float32")
+
+        if self.best > 0 and (removed["單位能耗"] == self.best).any():
+            rest = df.drop(index=remove) if same_rows else df
+            best = DataEngine.best_unit_energy(rest)
+            if added is not None: best = self._merge_best(best, DataEngine.best_unit_energy(added))
+        elif added is not None:
+            best = self._merge_best(self.best, DataEngine.best_unit_energy(added))
+        else:
+            best = self.best
+
+        if best != self.best: df = self._with_losses(df, best)
+        self.best = best
+        if added is not None:
+            added = self._with_losses(added, best)
+            self.agg.add_chunk(added)
+            DataEngine.union_categories(df, added)
+            if same_rows: df.loc[add, added.columns] = added
+            else: df = pd.concat([df, added])
+
+        self.df = df if same_rows else df.loc[edited_df.index]
+        self.delta = copy.deepcopy(delta)
+        return self._result()
+
+    def _result(self):
+        self.agg.best_energy = self.best
+        summary_agg, _, analysis_scope = self.agg.finalize()
+        return self.df, summary_agg, analysis_scope
+
+class WhatIfModel:
+    """參數模擬用的預先計算係數，參數變動時以 O(群組數) 重算各群組損失，不必逐列重算。
+
+    能源損失 = 電價 × Σ max(0, (單位能耗 - 最佳單位能耗) × 產量)，括號內與參數無關，每群組存一個係數。
+    產能損失 = 獲利 × Σ_{0<OEE<目標} (目標 × 產量/OEE - 產量)；各群組列依 OEE 排序並存累積和，
+    目標值改變時以二分搜尋找出 OEE < 目標的列數，直接由累積和相減得到。
+    """
+    def __init__(self, df, group_col):
+        self.group_col = group_col
+        codes, groups = pd.factorize(df[group_col])
+        self.groups = DataEngine.plain(pd.Series(groups)).to_numpy()
+        n = len(self.groups)
+        unit = df["單位能耗"].to_numpy(dtype="float64")
+        prod = df["產量"].to_numpy(dtype="float64")
+        oee = df["OEE"].to_numpy(dtype="float64")
+
+        has_group = codes >= 0
+        energy = (unit - DataEngine.best_unit_energy(df)) * prod
+        energy = np.where(energy > 0, energy, 0.0)
+        self.energy_coef = np.bincount(codes[has_group], weights=energy[has_group], minlength=n)
+
+        # 產量為空的列在逐列計算時是 NaN，加總時略過，這裡直接排除
+        valid = has_group & (oee > 0) & ~np.isnan(prod)
+        order = np.lexsort((oee[valid], codes[valid]))
+        self.oee_sorted = oee[valid][order]
+        w = prod[valid][order]
+        self.bounds = np.searchsorted(codes[valid][order], np.arange(n + 1))
+        # 累積和在各群組內從頭起算，避免跨群組的大數相減損失精度
+        ratio = w / self.oee_sorted
+        self.cum_ratio, self.cum_prod = np.empty_like(ratio), np.empty_like(w)
+        for s, e in zip(self.bounds[:-1], self.bounds[1:]):
+            np.cumsum(ratio[s:e], out=self.cum_ratio[s:e])
+            np.cumsum(w[s:e], out=self.cum_prod[s:e])
+
+    @property
+    def nbytes(self):
+        return int(self.energy_coef.nbytes + self.oee_sorted.nbytes + self.cum_ratio.nbytes + self.cum_prod.nbytes
+                   + self.bounds.nbytes + self.groups.nbytes)
+
+    def losses(self, params):
+        """各群組 (能源損失, 產能損失機會成本, 總損失)，以群組值為索引"""
+        target = params['target_oee'] / 100
+        start, stop = self.bounds[:-1], self.bounds[1:]
+        end = np.array([s + np.searchsorted(self.oee_sorted[s:e], target) for s, e in zip(start, stop)], dtype="int64")
+        # end 為群組內第一個 OEE >= 目標的位置，其前一列的群組內累積和即為缺口列的加總
+        last, hit = np.maximum(end - 1, 0), end > start
+        gap = np.where(hit, target * self.cum_ratio[last] - self.cum_prod[last], 0.0) if len(self.cum_ratio) else np.zeros(len(end))
+        out = pd.DataFrame({
+            "能源損失": self.energy_coef * params['elec_price'],
+            "產能損失機會成本": gap * params['product_margin'],
+        }, index=pd.Index(self.groups, name=self.group_col))
+        out["總損失"] = out["能源損失"] + out["產能損失機會成本"]
+        return out
+
+    def summary(self, group_stats, params):
+        """以不含損失的群組統計組出與 DataEngine.summarize 相同欄位的績效總表"""
+        losses = self.losses(params).reindex(group_stats[self.group_col].to_numpy())
+        summary_agg = group_stats.drop(columns="平均單位能耗")
+        for col in DataEngine.LOSS_COLS: summary_agg[col] = losses[col].to_numpy()
+        summary_agg["平均單位能耗"] = group_stats["平均單位能耗"]
+        return summary_agg
+
+    def grid_losses(self, prices, targets, margins):
+        """一次計算所有參數組合下各群組的總損失，回傳形狀 (電價, 目標 OEE, 獲利, 群組) 的陣列"""
+        prices, margins = np.asarray(prices, dtype="float64"), np.asarray(margins, dtype="float64")
+        t = np.asarray(targets, dtype="float64") / 100
+        gap = np.zeros((len(self.groups), len(t)))
+        if len(self.cum_ratio):
+            # 每個群組對所有目標值一次二分搜尋，得到 (群組, 目標) 的缺口加總
+            for g, (s, e) in enumerate(zip(self.bounds[:-1], self.bounds[1:])):
+                end = s + np.searchsorted(self.oee_sorted[s:e], t)
+                last = np.maximum(end - 1, 0)
+                gap[g] = np.where(end > s, t * self.cum_ratio[last] - self.cum_prod[last], 0.0)
+        return (prices[:, None, None, None] * self.energy_coef[None, None, None, :]
+                + margins[None, None, :, None] * gap.T[None, :, None, :])
+
+class SensitivityAnalysis:
+    """參數敏感度：以 WhatIfModel 的係數一次廣播計算整個參數網格，不需逐情境重跑分析"""
+    # 龍捲風圖各參數的高低擺幅：電價與獲利為相對比例，目標 OEE 為百分點
+    SWING = {'elec_price': 0.2, 'target_oee': 5.0, 'product_margin': 0.2}
+    LABELS = {'elec_price': "電價 (元/度)", 'target_oee': "目標 OEE (%)", 'product_margin': "獲利估算 (元/雙)"}
+
+    @staticmethod
+    def _low_high(params, name):
+        base, swing = params[name], SensitivityAnalysis.SWING[name]
+        if name == 'target_oee': return max(base - swing, 0.0), min(base + swing, 100.0)
+        return base * (1 - swing), base * (1 + swing)
+
+    @staticmethod
+    def _range(params, name, steps):
+        # 熱圖網格涵蓋兩倍擺幅
+        base, swing = params[name], SensitivityAnalysis.SWING[name]
+        if name == 'target_oee':
+            # 目標 OEE 限於 0~100：靠近邊界時以整數個格距平移網格 (基準值仍在格點上)，不讓多個格點被截成同一值
+            step = 4 * swing / (steps - 1)
+            shift = np.ceil(max(0.0 - (base - 2 * swing), 0.0) / step) - np.ceil(max(base + 2 * swing - 100.0, 0.0) / step)
+            grid = np.linspace(base - 2 * swing, base + 2 * swing, steps) + shift * step
+            return np.unique(np.clip(grid, 0.0, 100.0))
+        # 基準為 0 時相對擺幅全為同一值，去除重複格點
+        return np.unique(np.linspace(base * (1 - 2 * swing), base * (1 + 2 * swing), steps))
+
+    @staticmethod
+    def analyze(model, params, steps=9):
+        """回傳 {'tornado': 各參數高低值的總損失, 'heatmap': 電價 × 目標 OEE 的總損失 (獲利固定於基準),
+        'base_total': 基準總損失, 'scenarios': 情境數}"""
+        names = list(SensitivityAnalysis.SWING)
+        # 每個參數軸為「低、基準、高」再併入熱圖網格，整個網格在同一次廣播內算完
+        axes = [np.unique(np.concatenate([[params[name], *SensitivityAnalysis._low_high(params, name)],
+                                          SensitivityAnalysis._range(params, name, steps) if name != 'product_margin' else []]))
+                for name in names]
+        totals = model.grid_losses(*axes).sum(axis=-1)
+        pos = lambda k, value: int(np.searchsorted(axes[k], value))
+        at = lambda **kw: totals[tuple(pos(k, kw.get(name, params[name])) for k, name in enumerate(names))]
+
+        rows = []
+        for name in names:
+            low, high = SensitivityAnalysis._low_high(params, name)
+            rows.append({"參數": SensitivityAnalysis.LABELS[name], "低值": low, "高值": high,
+                         "低值總損失": at(**{name: low}), "高值總損失": at(**{name: high})})
+        tornado = pd.DataFrame(rows)
+        tornado["影響幅度"] = (tornado["高值總損失"] - tornado["低值總損失"]).abs()
+        tornado = tornado.sort_values("影響幅度", ascending=False, ignore_index=True)
+
+        prices = SensitivityAnalysis._range(params, 'elec_price', steps)
+        targets = SensitivityAnalysis._range(params, 'target_oee', steps)
+        z = totals[np.ix_([pos(0, p) for p in prices], [pos(1, t) for t in targets], [pos(2, params['product_margin'])])][:, :, 0]
+        heatmap = pd.DataFrame(z.T, index=pd.Index(targets, name="目標 OEE (%)"), columns=pd.Index(prices, name="電價 (元/度)"))
+        return {'tornado': tornado, 'heatmap': heatmap, 'base_total': at(), 'scenarios': int(np.prod([len(a) for a in axes]))}
+
+    @staticmethod
+    def describe(sens):
+        top = sens['tornado'].iloc[0]
+        return (f"共試算 **{sens['scenarios']:,}** 組參數情境。對總損失影響最大的是 **{top['參數']}**："
+                f"在 {top['低值']:,.2f} ~ {top['高值']:,.2f} 之間變動時，總損失介於 **NT$ {min(top['低值總損失'], top['高值總損失']):,.0f}** "
+                f"至 **NT$ {max(top['低值總損失'], top['高值總損失']):,.0f}** (基準 NT$ {sens['base_total']:,.0f})。")
+
+# ==========================================
+# 3. Insight Engine
+# ==========================================
+class InsightEngine:
+    @staticmethod
+    def generate_narrative(df, summary_agg, group_col, params):
+        texts = {}
+        target_oee = params['target_oee'] / 100.0
+        margin = params['product_margin']
+        
+        avg_oee = df["OEE"].mean()
+        total_loss = df["總損失"].sum()
+        best_m = summary_agg.iloc[0]
+        worst_m = summary_agg.iloc[-1]
+        
+        texts['kpi_summary'] = f"本次分析區間內，整體平均 OEE 為 **{avg_oee:.1%}**。其中 **{best_m[group_col]}** 表現最佳，為全廠標竿；而 **{worst_m[group_col]}** 效率敬陪末座，是造成全廠 **NT$ {total_loss:,.0f}** 潛在損失的主要原因。"
+        
+        eff_gap_pct = 0
+        multiplier_msg = ""
+        if best_m['平均單位能耗'] > 0 and worst_m['平均單位能耗'] > 0:
+            eff_gap_pct = ((worst_m['平均單位能耗'] - best_m['平均單位能耗']) / best_m['平均單位能耗']) * 100
+            multiplier = worst_m['平均單位能耗'] / best_m['平均單位能耗']
+            multiplier_msg = f"換算下來，**{worst_m[group_col]}** 的耗能是標竿機台的 **{multiplier:.1f} 倍**。"
+
+        texts['benchmark_analysis'] = f"""
+        * **標竿設備 ({best_m[group_col]})**：表現最佳，平均 OEE 達 **{best_m['OEE']:.1%}**，單位能耗最低 ({best_m['平均單位能耗']:.5f} kWh/雙)。
+        * **瓶頸設備 ({worst_m[group_col]})**：表現最弱，單位生產成本比標竿高出 **{eff_gap_pct:.1f}%**。{multiplier_msg}
+        """
+        
+        texts['rank_desc'] = f"此圖表顯示各設備的綜合實力排名。數據顯示 **{best_m[group_col]}** 位於頂端，顯示其生產效率最優；反之 **{worst_m[group_col]}** 位於底部，建議優先檢討其作業流程。"
+        texts['dual_desc'] = "此圖對比了各機台的「產出量」與「耗電量」。正常的生產模式應為「高產出伴隨高耗電」。若發現某設備產出極低，但耗電量曲線卻未等比例下降，即代表存在無效能耗。"
+        texts['pie_desc'] = "此圖呈現各設備的總用電量佔比。若非主力生產設備卻佔據過高的用電比例，可能代表設備存在漏電、馬達老化或長時間待機未關機的問題。"
+        texts['unit_desc'] = f"此圖比較生產每一雙鞋的電力成本。**{best_m[group_col]}** 的柱狀最短，代表能源轉換效率最高；數值過高者建議檢查傳動系統阻力或加熱系統保溫效果。"
+
+        potential_prod = 0
+        if worst_m['OEE'] > 0:
+            potential_prod = (best_m['OEE'] - worst_m['OEE']) / worst_m['OEE'] * worst_m['產量']
+        potential_rev = potential_prod * margin
+        texts['opportunity_analysis'] = f"若能將 **{worst_m[group_col]}** 的效率提升至標竿水準，預計本期間可額外生產 **{potential_prod:,.0f} 雙**，相當於挽回 **NT$ {potential_rev:,.0f}** 的營收損失。"
+
+        cv_text = "數據量不足以計算波動率。"
+        if len(df) > 1:
+            oee_by_group = df.groupby(group_col, observed=True)["OEE"]
+            cv_series = oee_by_group.std() / oee_by_group.mean()
+            most_stable = cv_series.idxmin()
+            most_unstable = cv_series.idxmax()
+            cv_text = f"**{most_stable}** 生產節奏最穩定 (CV最低)；**{most_unstable}** 波動最大，顯示製程或人員操作存在變異。"
+        texts['stability_analysis'] = cv_text
+        texts['cv_desc'] = "變異係數 (CV) 用於衡量生產穩定度。數值越低代表品質與產出越穩定可控；數值過高則代表生產過程極不穩定。"
+        texts['scatter_desc'] = "此矩陣圖用於檢視效率與能耗的關聯。**右下角** (高OEE、低能耗) 為理想落點。若數據點落於 **左上角** (低OEE、高能耗)，通常代表設備處於「空轉浪費」狀態。"
+
+        crit_list, avg_list, good_list = [], [], []
+        for _, row in summary_agg.iterrows():
+            name = row[group_col]
+            if row['OEE'] >= target_oee: good_list.append(name)
+            elif row['OEE'] >= 0.7: avg_list.append(name)
+            else: crit_list.append(name)
+            
+        action_text = ""
+        if crit_list: action_text += f"🔴 **優先改善**：{', '.join(crit_list)}。OEE 低於 70%，請檢查待機未關機狀況。\n\n"
+        if avg_list: action_text += f"🟡 **效能提升**：{', '.join(avg_list)}。表現平穩，建議微調參數提升稼動率。\n\n"
+        if good_list: action_text += f"🟢 **標竿管理**：{', '.join(good_list)}。運作優異，建議標準化SOP。"
+        texts['action_plan'] = action_text
+        return texts
+
+# ==========================================
+# 3. Viz Engine (視覺化中心) - 版面與標籤優化
+# ==========================================
+class VizEngine:
+    @staticmethod
+    def _common_layout():
+        return dict(
+            plot_bgcolor='white',
+            font=dict(family='Arial, sans-serif', color='black', size=12),
+            xaxis=dict(showgrid=True, gridcolor='#f0f0f0'),
+            yaxis=dict(showgrid=True, gridcolor='#f0f0f0'),
+            margin=dict(l=40, r=40, t=40, b=80) # 增加底部 Margin 以防標籤被切掉
+        )
+
+    @staticmethod
+    def create_rank_chart(summary_agg, group_col):
+        try:
+            fig = px.bar(
+                summary_agg.sort_values("OEE", ascending=True),
+                x="OEE", y=group_col, orientation='h', text="OEE",
+                title="綜合實力排名 (依 OEE 排序)"
+            )
+            fig.update_traces(marker_color='#2E86C1', texttemplate='%{text:.1%}', textposition='outside')
+            fig.update_layout(VizEngine._common_layout())
+            fig.update_layout(xaxis=dict(range=[0, summary_agg['OEE'].max() * 1.25])) 
+            return fig
+        except: return go.Figure()
+
+    @staticmethod
+    def create_cv_chart(df, group_col):
+        try:
+            cv_data = df.groupby(group_col, observed=True)["OEE"].agg(['mean', 'std'])
+            cv_data['CV'] = (cv_data['std'] / cv_data['mean']) * 100
+            cv_data = cv_data.fillna(0).reset_index()
+            cv_data[group_col] = DataEngine.plain(cv_data[group_col])
+            fig = px.bar(cv_data, x=group_col, y="CV", text="CV", title="生產穩定度 (CV變異係數)")
+            fig.update_traces(marker_color='#C0392B', texttemplate='%{text:.1f}%', textposition='outside')
+            fig.update_layout(VizEngine._common_layout())
+            fig.update_layout(yaxis=dict(range=[0, cv_data['CV'].max() * 1.2])) # 增加頂部空間
+            return fig
+        except: return go.Figure()
+
+    # 散佈圖點數門檻：超過 WEBGL 改用 Scattergl，超過 MAX_POINTS 先抽樣，超過 DENSITY 改畫密度熱圖
+    SCATTER_WEBGL_ROWS = 20_000
+    SCATTER_MAX_POINTS = 100_000
+    SCATTER_DENSITY_ROWS = 2_000_000
+
+    @staticmethod
+    def _grid_bins(values, bins):
+        values = np.nan_to_num(values.astype("float64"), nan=0.0, posinf=0.0, neginf=0.0)
+        lo, hi = values.min(), values.max()
+        if hi <= lo: return np.zeros(len(values), dtype="int64")
+        return np.minimum(((values - lo) / (hi - lo) * bins).astype("int64"), bins - 1)
+
+    @staticmethod
+    def downsample_points(df, x, y, max_points, bins=64, min_keep=20, seed=0):
+        """依 x/y 網格分層抽樣：各格以相同比例保留以維持密度，點數少的稀疏格則全數保留以保住離群值。
+        固定亂數種子，相同資料每次得到相同結果 (圖表快取可重用)。"""
+        if len(df) <= max_points: return df
+        cell = VizEngine._grid_bins(df[x].to_numpy(), bins) * bins + VizEngine._grid_bins(df[y].to_numpy(), bins)
+        counts = np.bincount(cell, minlength=bins * bins)
+        keep_prob = np.maximum(max_points / len(df), np.minimum(1.0, min_keep / counts[cell]))
+        return df[np.random.default_rng(seed).random(len(df)) < keep_prob]
+
+    @staticmethod
+    def _density_heatmap(df, bins=80):
+        data = df[["OEE", "單位能耗"]].replace([np.inf, -np.inf], np.nan).dropna()
+        hist, x_edges, y_edges = np.histogram2d(data["OEE"], data["單位能耗"], bins=bins)
+        fig = go.Figure(go.Heatmap(
+            x=(x_edges[:-1] + x_edges[1:]) / 2, y=(y_edges[:-1] + y_edges[1:]) / 2, z=hist.T,
+            colorscale="Blues", colorbar=dict(title="筆數")
+        ))
+        fig.update_layout(VizEngine._common_layout())
+        fig.update_layout(title=f"效率 vs 能耗 關聯分析 (密度圖，{len(df):,} 筆)", xaxis_title="OEE", yaxis_title="單位能耗")
+        return fig
+
+    @staticmethod
+    def create_scatter_chart(df, group_col):
+        try:
+            if len(df) > VizEngine.SCATTER_DENSITY_ROWS: return VizEngine._density_heatmap(df)
+            title = "效率 vs 能耗 關聯分析"
+            plot_df = VizEngine.downsample_points(df, "OEE", "單位能耗", VizEngine.SCATTER_MAX_POINTS)
+            if len(plot_df) < len(df): title += f" (抽樣 {len(plot_df):,} / {len(df):,} 筆)"
+            plot_df = plot_df.assign(**{group_col: DataEngine.plain(plot_df[group_col])})
+            fig = px.scatter(
+                plot_df, x="OEE", y="單位能耗", color=group_col, size="產量",
+                title=title,
+                color_discrete_sequence=px.colors.qualitative.Set1,
+                render_mode="webgl" if len(plot_df) > VizEngine.SCATTER_WEBGL_ROWS else "auto"
+            )
+            fig.update_layout(VizEngine._common_layout())
+            return fig
+        except: return go.Figure()
+
+    # 趨勢圖最多個別繪出的群組數，其餘合併為「其他」
+    DUAL_MAX_GROUPS = 12
+    # 各時間桶的 x 軸日期格式；跨年的週/月彙總需帶年份
+    TREND_DATE_FMT = {"D": "%m-%d", "W": "%Y-%m-%d", "M": "%Y-%m"}
+    TREND_TITLE = {"D": "", "W": " (週彙總)", "M": " (月彙總)"}
+
+    @staticmethod
+    def create_dual_axis_chart(df, group_col, max_groups=None, selected=None, freq="D"):
+        try:
+            max_groups = max_groups or VizEngine.DUAL_MAX_GROUPS
+            df = df.assign(**{group_col: DataEngine.plain(df[group_col])})
+            machines = df[group_col].unique()
+            others_label = None
+            if selected:
+                chosen = set(selected)
+                machines = [m for m in machines if m in chosen]
+                df = df[df[group_col].isin(chosen)]
+            elif len(machines) > max_groups:
+                # 依總損失取前 N 名個別繪製，其餘依日期合計成單一系列，控制 trace 數與圖表大小
+                top = set(df.groupby(group_col)["總損失"].sum().nlargest(max_groups).index)
+                is_top = df[group_col].isin(top)
+                others_label = f"其他 ({len(machines) - len(top)} 台)"
+                others = df.loc[~is_top].astype({"產量": "float64", "耗電量": "float64"}).groupby("日期", sort=False)[["產量", "耗電量"]].sum(min_count=1).reset_index()
+                others[group_col] = others_label
+                machines = [m for m in machines if m in top] + [others_label]
+                df = pd.concat([df.loc[is_top, ["日期", group_col, "產量", "耗電量"]], others], ignore_index=True)
+
+            df_sorted = df.sort_values(["日期", group_col])
+            # 修正：逐日資料只顯示 MM-DD (不含年份)，避免標籤太長；只格式化不重複的日期再展開回各列
+            date_codes, dates = pd.factorize(df_sorted["日期"])
+            date_text = pd.DatetimeIndex(dates).strftime(VizEngine.TREND_DATE_FMT[freq]).to_numpy(dtype=object)
+            x_label = (date_text[date_codes] + " " + df_sorted[group_col].astype(str).to_numpy(dtype=object))
+            prod = df_sorted["產量"].to_numpy()
+            energy = df_sorted["耗電量"].to_numpy()
+            # 單次 groupby 取得各機台的列位置，取代逐台重新篩選
+            positions = df_sorted.groupby(group_col, sort=False).indices
+            
+            # 自動分配顏色
+            colors = px.colors.qualitative.Plotly
+            
+            traces = []
+            for i, machine in enumerate(machines):
+                idx = positions[machine]
+                m_x_label = x_label[idx]
+                color = '#7f8c8d' if machine == others_label else colors[i % len(colors)]
+                
+                traces.append(dict(
+                    type="bar", x=m_x_label, y=prod[idx], 
+                    name=f"{machine} 產量",
+                    marker_color=color, opacity=0.6
+                ))
+                traces.append(dict(
+                    type="scatter", x=m_x_label, y=energy[idx], 
+                    name=f"{machine} 耗電",
+                    yaxis="y2", mode="lines+markers",
+                    line=dict(color=color, width=3)
+                ))
+            # 以 dict 一次建立所有 trace，避免逐條 add_trace 反覆驗證並深複製資料陣列
+            fig = go.Figure(data=traces)
+
+            layout = VizEngine._common_layout()
+            layout.update(dict(
+                title="各機台產量與耗電量趨勢對比" + VizEngine.TREND_TITLE[freq],
+                yaxis=dict(title="產量 (雙)"),
+                yaxis2=dict(title="耗電量 (kWh)", overlaying="y", side="right", showgrid=False),
+                xaxis=dict(tickangle=45), # 標籤旋轉
+                barmode='group',
+                legend=dict(orientation="h", y=-0.2) # 圖例移到底部，避免擋住標題
+            ))
+            fig.update_layout(layout)
+            return fig
+        except Exception as e:
+            return go.Figure()
+
+    @staticmethod
+    def create_loss_chart(summary_agg, group_col):
+        try:
+            sorted_agg = summary_agg.sort_values("總損失", ascending=True)
+            fig = px.bar(
+                sorted_agg, x=["能源損失", "產能損失機會成本"], y=group_col, orientation='h',
+                title="潛在損失組成 (能源損失 + 產能損失機會成本)",
+                color_discrete_sequence=['#E67E22', '#8E44AD']
+            )
+            fig.update_layout(VizEngine._common_layout())
+            fig.update_layout(xaxis_title="NT$", legend_title_text="", legend=dict(orientation="h", y=-0.2))
+            return fig
+        except: return go.Figure()
+
+    @staticmethod
+    def create_tornado_chart(sens):
+        try:
+            data = sens['tornado'].iloc[::-1]
+            base = sens['base_total']
+            fig = go.Figure([
+                go.Bar(y=data["參數"], x=data["低值總損失"] - base, base=base, orientation='h', name="參數調低",
+                       marker_color='#2E86C1', text=[f"{v:,.2f}" for v in data["低值"]], textposition='outside'),
+                go.Bar(y=data["參數"], x=data["高值總損失"] - base, base=base, orientation='h', name="參數調高",
+                       marker_color='#C0392B', text=[f"{v:,.2f}" for v in data["高值"]], textposition='outside'),
+            ])
+            fig.update_layout(VizEngine._common_layout())
+            fig.update_layout(title="參數敏感度 (龍捲風圖，總損失)", barmode='overlay', xaxis_title="總損失 (NT$)",
+                              legend=dict(orientation="h", y=-0.2))
+            fig.add_vline(x=base, line_dash="dash", line_color="black")
+            return fig
+        except: return go.Figure()
+
+    @staticmethod
+    def create_sensitivity_heatmap(sens):
+        try:
+            heat = sens['heatmap']
+            fig = go.Figure(go.Heatmap(
+                x=[f"{v:.2f}" for v in heat.columns], y=[f"{v:.1f}" for v in heat.index], z=heat.to_numpy(),
+                colorscale="Reds", colorbar=dict(title="總損失")
+            ))
+            fig.update_layout(VizEngine._common_layout())
+            fig.update_layout(title="總損失情境熱圖 (電價 × 目標 OEE)", xaxis_title=heat.columns.name, yaxis_title=heat.index.name)
+            return fig
+        except: return go.Figure()
+
+    @staticmethod
+    def create_pie_chart(summary_agg, group_col):
+        try:
+            fig = px.pie(summary_agg, values="耗電量", names=group_col, hole=0.4, title="總耗電量佔比")
+            fig.update_traces(textinfo='percent+label', textfont=dict(size=14, color='black'), marker=dict(colors=px.colors.qualitative.Safe))
+            fig.update_layout(VizEngine._common_layout())
+            return fig
+        except: return go.Figure()
+
+    @staticmethod
+    def create_unit_energy_chart(summary_agg, group_col):
+        try:
+            sorted_agg = summary_agg.sort_values("平均單位能耗")
+            fig = px.bar(
+                sorted_agg, x=group_col, y="平均單位能耗", text="平均單位能耗",
+                title="平均單位能耗 (越低越好)"
+            )
+            fig.update_traces(marker_color='#145a32', texttemplate='%{text:.5f}', textposition='outside')
+            layout = VizEngine._common_layout()
+            layout.update(yaxis=dict(range=[0, sorted_agg['平均單位能耗'].max() * 1.2]))
+            fig.update_layout(layout)
+            return fig
+        except: return go.Figure()
+
+# ==========================================
+# 4. Report Engine
+# ==========================================
+class ImageCache:
+    """圖表 PNG 的內容定址快取：以圖表 JSON 與輸出尺寸為鍵，記憶體 LRU 為主，可選擇加上磁碟層。"""
+    def __init__(self, cache_dir=None, max_bytes=128 * 1024 ** 2):
+        self.memory = ResultCache(max_bytes=max_bytes, max_entries=512)
+        self.cache_dir = cache_dir
+        if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(fig, width, height, scale):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(fig.to_json().encode())
+        h.update(f"{width}x{height}@{scale}".encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        img = self.memory.get(key)
+        if img is None and self.cache_dir:
+            path = os.path.join(self.cache_dir, f"{key}.png")
+            if os.path.exists(path):
+                with open(path, 'rb') as f: img = f.read()
+                self.memory.put(key, img, len(img))
+        return img
+
+    def put(self, key, img):
+        self.memory.put(key, img, len(img))
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f"{key}.png")
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f: f.write(img)
+            os.replace(tmp_path, path)
+
+class FigureRasterizer:
+    """以有上限的執行緒池平行轉出圖表 PNG，每個工作執行緒各自持有一個常駐的 Kaleido 程序。"""
+    def __init__(self, max_workers=4, cache=None):
+        self.max_workers = max_workers
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="kaleido")
+        self._local = threading.local()
+
+    def _scope(self):
+        scope = getattr(self._local, 'scope', None)
+        if scope is None:
+            scope = PlotlyScope()
+            base = pio.kaleido.scope
+            if base is not None: scope.plotlyjs, scope.mathjax = base.plotlyjs, base.mathjax
+            self._local.scope = scope
+        return scope
+
+    def _render(self, fig, width, height, scale):
+        # 全域 Kaleido scope 會以鎖串行化所有呼叫，因此改用每個執行緒專屬的 scope
+        if PlotlyScope is None: return fig.to_image(format="png", width=width, height=height, scale=scale)
+        return self._scope().transform(fig.to_dict(), format="png", width=width, height=height, scale=scale)
+
+    def _render_cached(self, fig, width, height, scale):
+        if self.cache is None: return self._render(fig, width, height, scale)
+        key = ImageCache.key(fig, width, height, scale)
+        img = self.cache.get(key)
+        if img is None:
+            img = self._render(fig, width, height, scale)
+            self.cache.put(key, img)
+        return img
+
+    def render_all(self, figures, width=800, height=400, scale=1.5, progress=None):
+        futures = {self._executor.submit(self._render_cached, fig, width, height, scale): key for key, fig in figures.items()}
+        images = {}
+        for i, fut in enumerate(as_completed(futures), 1):
+            try: images[futures[fut]] = fut.result()
+            except Exception: images[futures[fut]] = None
+            if progress: progress(i, len(futures))
+        return images
+
+class ReportEngine:
+    @staticmethod
+    def clean_markdown(text):
+        if not isinstance(text, str): return str(text)
+        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+        text = re.sub(r'🔴|🟡|🟢', '', text)
+        return text.strip()
+
+    @staticmethod
+    def generate_docx(df, summary_agg, texts, figures, analysis_scope, progress=None, rasterizer=None, timer=None, sensitivity=None):
+        timer = timer or StageTimer.DISABLED
+        # 沒有敏感度結果時不轉出敏感度圖表
+        if sensitivity is None: figures = {k: v for k, v in figures.items() if k not in ('tornado', 'heatmap')}
+        doc = Document()
+        style = doc.styles['Normal']
+        style.font.name = 'Arial'
+        style.font.size = Pt(11)
+        
+        head = doc.add_heading('生產效能診斷分析報告', 0)
+        head.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        doc.add_paragraph(f"分析範圍：{clean_text_for_word(analysis_scope)}")
+        doc.add_paragraph(f"期間：{df['日期'].min():%Y-%m-%d} ~ {df['日期'].max():%Y-%m-%d}")
+        doc.add_paragraph("-" * 60)
+        
+        doc.add_heading('1. 總體績效概覽', level=1)
+        doc.add_paragraph(ReportEngine.clean_markdown(texts['kpi_summary']))
+        
+        table = doc.add_table(rows=1, cols=len(summary_agg.columns))
+        table.style = 'Table Grid'
+        hdr = table.rows[0].cells
+        for i, col in enumerate(summary_agg.columns): hdr[i].text = str(col)
+        
+        for _, row in summary_agg.iterrows():
+            cells = table.add_row().cells
+            for i, val in enumerate(row):
+                col_name = summary_agg.columns[i]
+                if "OEE" in col_name: cells[i].text = f"{val:.1%}"
+                elif "能耗" in col_name: cells[i].text = f"{val:.5f}"
+                elif "損失" in col_name or "產量" in col_name: cells[i].text = f"{val:,.0f}"
+                elif isinstance(val, float): cells[i].text = f"{val:.1f}"
+                else: cells[i].text = str(val)
+        
+        doc.add_heading('2. 深度診斷分析', level=1)
+        doc.add_paragraph(ReportEngine.clean_markdown(texts['benchmark_analysis']))
+        doc.add_paragraph(ReportEngine.clean_markdown(texts['opportunity_analysis']))
+        
+        # 先一次轉出所有圖表 (平行)，再依章節順序插入
+        with timer.span("圖表轉檔 (Kaleido)"):
+            if rasterizer is not None:
+                images = rasterizer.render_all(figures, progress=progress)
+            else:
+                images = {}
+                for i, (key, fig) in enumerate(figures.items(), 1):
+                    try: images[key] = fig.to_image(format="png", width=800, height=400, scale=1.5)
+                    except: images[key] = None
+                    if progress: progress(i, len(figures))
+
+        def add_fig_section(key, title, desc_key):
+            doc.add_heading(title, level=2)
+            if key in figures:
+                try: doc.add_picture(BytesIO(images[key]), width=Inches(6.0))
+                except: doc.add_paragraph("[圖表略]")
+            if desc_key in texts:
+                doc.add_paragraph(ReportEngine.clean_markdown(texts[desc_key]))
+
+        add_fig_section('rank', '綜合實力排名', 'rank_desc')
+        add_fig_section('dual', '產量與能耗趨勢', 'dual_desc')
+        
+        doc.add_heading('3. 電力耗能分析', level=1)
+        add_fig_section('pie', '總耗電量佔比', 'pie_desc')
+        add_fig_section('unit', '平均單位能耗', 'unit_desc')
+        
+        doc.add_heading('4. 生產穩定性', level=1)
+        doc.add_paragraph(ReportEngine.clean_markdown(texts['stability_analysis']))
+        add_fig_section('cv', 'CV 變異係數', 'cv_desc')
+        add_fig_section('scatter', '效率能耗矩陣', 'scatter_desc')
+        
+        doc.add_heading('5. 策略行動建議', level=1)
+        doc.add_paragraph(ReportEngine.clean_markdown(texts['action_plan']))
+
+        if sensitivity is not None:
+            doc.add_heading('6. 參數敏感度分析', level=1)
+            doc.add_paragraph(ReportEngine.clean_markdown(SensitivityAnalysis.describe(sensitivity)))
+            table = doc.add_table(rows=1, cols=5)
+            table.style = 'Table Grid'
+            for cell, text in zip(table.rows[0].cells, ["參數", "低值", "高值", "低值總損失", "高值總損失"]): cell.text = text
+            for _, row in sensitivity['tornado'].iterrows():
+                cells = table.add_row().cells
+                cells[0].text = row["參數"]
+                cells[1].text, cells[2].text = f"{row['低值']:,.2f}", f"{row['高值']:,.2f}"
+                cells[3].text, cells[4].text = f"{row['低值總損失']:,.0f}", f"{row['高值總損失']:,.0f}"
+            add_fig_section('tornado', '參數敏感度', None)
+            add_fig_section('heatmap', '總損失情境熱圖', None)
+        
+        bio = BytesIO()
+        doc.save(bio)
+        return bio
+
+# ==========================================
+# 5. Analysis Pipeline (結果快取)
+# ==========================================
+class ResultCache:
+    """跨 session 共用的 LRU 快取，超過筆數或記憶體預算時淘汰最久未使用的結果。
+    快取內的物件為共用唯讀資料，呼叫端不可修改。"""
+    def __init__(self, max_bytes=512 * 1024 ** 2, max_entries=32):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.nbytes = 0
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._store: return None
+            self._store.move_to_end(key)
+            return self._store[key][0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._store: self.nbytes -= self._store.pop(key)[1]
+            if nbytes > self.max_bytes: return
+            self._store[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes or len(self._store) > self.max_entries:
+                _, (_, size) = self._store.popitem(last=False)
+                self.nbytes -= size
+
+class StageTimer:
+    """各階段耗時紀錄；以 span(名稱) 包住要量測的區段，可巢狀。停用時 span 回傳共用的空 context，不做任何記錄。
+    memory=True 時另以 tracemalloc 記錄每個區段的配置峰值與結束時留存的配置量，並可用 track() 記錄個別物件大小。
+    tracemalloc 為整個行程共用：以參照計數啟停，最後一個記憶體剖析的 timer 關閉時才停止追蹤；
+    但配置量會包含同時執行的其他 session，多個 session 同時剖析時 reset_peak 也會互相影響，數字僅在單一使用者偵錯時準確。"""
+    _NULL = nullcontext()
+    _trace_lock = threading.Lock()
+    _trace_users = 0
+    _trace_owned = False
+
+    def __init__(self, enabled=True, memory=False):
+        self.enabled = enabled
+        self.memory = enabled and memory
+        self.spans = []
+        self.objects = []
+        self._stack = []
+        self._t0 = time.perf_counter()
+        self._tracing = False
+        if self.memory:
+            with StageTimer._trace_lock:
+                # 已由外部 (例如 python -X tracemalloc) 啟動時沿用，不由這裡停止
+                if StageTimer._trace_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    StageTimer._trace_owned = True
+                StageTimer._trace_users += 1
+            self._tracing = True
+
+    def close(self):
+        if not self._tracing: return
+        self._tracing = False
+        with StageTimer._trace_lock:
+            StageTimer._trace_users -= 1
+            if StageTimer._trace_users == 0 and StageTimer._trace_owned:
+                tracemalloc.stop()
+                StageTimer._trace_owned = False
+
+    @contextmanager
+    def _span(self, name):
+        parent = self._stack[-1] if self._stack else None
+        # 每層記下進入時的配置量與目前看到的峰值；reset_peak 後內層峰值要回填到外層，外層峰值才不會被內層洗掉
+        frame = {'name': name, 'current': 0, 'peak': 0}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None: parent['peak'] = max(parent['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['current'] = frame['peak'] = current
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try: yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._stack.pop()
+            record = {'stage': name, 'parent': parent['name'] if parent else None, 'depth': len(self._stack),
+                      'start': round(start - self._t0, 6), 'seconds': round(seconds, 6)}
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, frame['peak'])
+                if parent is not None: parent['peak'] = max(parent['peak'], peak)
+                record['peak_bytes'] = peak - frame['current']
+                record['retained_bytes'] = current - frame['current']
+            self.spans.append(record)
+
+    def span(self, name):
+        return self._span(name) if self.enabled else StageTimer._NULL
+
+    def track(self, name, obj):
+        """記錄物件 (DataFrame 或圖表 dict) 的記憶體大小；只在記憶體剖析模式下計算"""
+        if not self.memory or obj is None: return
+        if isinstance(obj, pd.DataFrame): nbytes = int(obj.memory_usage(deep=True).sum())
+        elif isinstance(obj, dict): nbytes = sum(len(fig.to_json()) for fig in obj.values())
+        else: nbytes = len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        self.objects.append({'object': name, 'bytes': nbytes, 'id': id(obj)})
+
+    def records(self):
+        return sorted(self.spans, key=lambda r: (r['start'], r['depth']))
+
+    def to_json(self):
+        total = sum(r['seconds'] for r in self.spans if r['depth'] == 0)
+        data = {'total_seconds': round(total, 6), 'spans': self.records()}
+        if self.memory: data['objects'] = self.objects
+        return json.dumps(data, ensure_ascii=False, indent=2)
+
+StageTimer.DISABLED = StageTimer(enabled=False)
+
+class AnalysisPipeline:
+    """分析流程拆成宣告輸入的階段 (DAG)，每個階段以「上游階段鍵 + 實際用到的參數」為快取鍵各自快取。
+    只改電價/目標 OEE/獲利時，資料清理、群組統計與不含損失的圖表都直接沿用，只重算損失與其下游。"""
+    LOSS_PARAMS = ('elec_price', 'target_oee', 'product_margin')
+
+    @staticmethod
+    def _prepared(params, df_input, timer=None):
+        timer = timer or StageTimer.DISABLED
+        with timer.span("複製輸入資料"): df = df_input.copy()
+        with timer.span("欄位轉換與指標"): df, err = DataEngine.prepare(df)
+        if err: return None, None, err
+        group_col = "廠別" if df["廠別"].nunique() > 1 else "機台編號"
+        return df, group_col, "跨廠區分析" if group_col == "廠別" else "單廠設備分析"
+
+    @staticmethod
+    def _losses(params, prepared):
+        # 淺複製後新增/覆寫損失欄位，快取中的清理結果不會被修改
+        df = DataEngine.compute_losses(prepared[0].copy(deep=False), DataEngine.best_unit_energy(prepared[0]), params)
+        df["總損失"] = df["能源損失"] + df["產能損失機會成本"]
+        return df
+
+    # 階段名稱: (上游階段, 使用的參數, 計算函式)；'data' 為輸入資料本身
+    STAGES = {
+        'prepared': (('data',), (), lambda params, df, timer=None: AnalysisPipeline._prepared(params, df, timer)),
+        'group_stats': (('prepared',), (), lambda params, prep: DataEngine.summarize(prep[0], prep[1], with_losses=False)),
+        'losses': (('prepared',), LOSS_PARAMS, lambda params, prep: AnalysisPipeline._losses(params, prep)),
+        'summary': (('prepared', 'losses'), (), lambda params, prep, df: DataEngine.summarize(df, prep[1])),
+        'texts': (('prepared', 'losses', 'summary'), ('target_oee', 'product_margin'),
+                  lambda params, prep, df, summary: InsightEngine.generate_narrative(df, summary, prep[1], params)),
+        'trend': (('prepared', 'losses'), (), lambda params, prep, df: DataEngine.rollup_trend(df, prep[1])),
+        'fig_rank': (('prepared', 'group_stats'), (), lambda params, prep, stats: VizEngine.create_rank_chart(stats, prep[1])),
+        'fig_cv': (('prepared',), (), lambda params, prep: VizEngine.create_cv_chart(prep[0], prep[1])),
+        'fig_scatter': (('prepared',), (), lambda params, prep: VizEngine.create_scatter_chart(prep[0], prep[1])),
+        'fig_dual': (('prepared', 'trend'), (),
+                     lambda params, prep, trend: VizEngine.create_dual_axis_chart(trend[0], prep[1], freq=trend[1])),
+        'fig_pie': (('prepared', 'group_stats'), (), lambda params, prep, stats: VizEngine.create_pie_chart(stats, prep[1])),
+        'fig_unit': (('prepared', 'group_stats'), (), lambda params, prep, stats: VizEngine.create_unit_energy_chart(stats, prep[1])),
+        'whatif': (('prepared',), (), lambda params, prep: WhatIfModel(prep[0], prep[1])),
+        'sensitivity': (('whatif',), LOSS_PARAMS, lambda params, model: SensitivityAnalysis.analyze(model, params)),
+        'fig_tornado': (('sensitivity',), (), lambda params, sens: VizEngine.create_tornado_chart(sens)),
+        'fig_heatmap': (('sensitivity',), (), lambda params, sens: VizEngine.create_sensitivity_heatmap(sens)),
+    }
+    STAGE_LABELS = {
+        'prepared': "資料清理與指標", 'group_stats': "群組統計", 'losses': "損失計算", 'summary': "績效總表",
+        'texts': "診斷文字", 'trend': "趨勢彙總", 'fig_rank': "圖表：rank", 'fig_cv': "圖表：cv",
+        'fig_scatter': "圖表：scatter", 'fig_dual': "圖表：dual", 'fig_pie': "圖表：pie", 'fig_unit': "圖表：unit",
+        'whatif': "模擬係數", 'sensitivity': "敏感度網格", 'fig_tornado': "圖表：tornado", 'fig_heatmap': "圖表：heatmap",
+    }
+    FIGURES = ['rank', 'cv', 'scatter', 'dual', 'pie', 'unit', 'tornado', 'heatmap']
+
+    @staticmethod
+    def fingerprint(df, params=None):
+        """資料內容的雜湊；給 params 時再併入參數 (整份結果的識別鍵)"""
+        h = hashlib.blake2b(digest_size=16)
+        h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+        h.update(repr((list(df.columns), [str(t) for t in df.dtypes])).encode())
+        key = h.hexdigest()
+        return key if params is None else AnalysisPipeline.stage_key(key, sorted(params.items()))
+
+    @staticmethod
+    def stage_key(*parts):
+        return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _nbytes(value):
+        if isinstance(value, WhatIfModel): return value.nbytes
+        if isinstance(value, pd.DataFrame): return int(value.memory_usage(deep=True).sum())
+        if isinstance(value, (tuple, list)): return sum(AnalysisPipeline._nbytes(v) for v in value)
+        if isinstance(value, (str, int, float)) or value is None: return 64
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _evaluator(df_input, params, process=None, timer=None, cache=None, data_key=None):
+        """回傳 get(階段名稱)，依 DAG 取得該階段結果；cache 為 None 時不跨次快取。
+        process 可取代資料清理與損失計算 (例如增量重算)，回傳 (df, 總表, 範圍)，只在清理結果不在快取時呼叫。"""
+        timer = timer or StageTimer.DISABLED
+        keys, values = {'data': data_key or AnalysisPipeline.fingerprint(df_input)}, {'data': df_input}
+
+        def key_of(name):
+            if name not in keys:
+                inputs, used, _ = AnalysisPipeline.STAGES[name]
+                keys[name] = AnalysisPipeline.stage_key(name, *[key_of(i) for i in inputs], *[(p, params[p]) for p in used])
+            return keys[name]
+
+        def store(name, value):
+            values[name] = value
+            if cache is not None: cache.put(key_of(name), value, AnalysisPipeline._nbytes(value))
+
+        def get(name):
+            if name in values: return values[name]
+            value = cache.get(key_of(name)) if cache is not None else None
+            if value is not None:
+                values[name] = value
+                return value
+            if name == 'prepared' and process is not None:
+                with timer.span("增量重算"):
+                    df, summary, scope = process()
+                if df is None or summary is None:
+                    values[name] = (None, None, scope)
+                    return values[name]
+                store('prepared', (df, "廠別" if scope == "跨廠區分析" else "機台編號", scope))
+                store('losses', df)
+                store('summary', summary)
+                return values[name]
+            inputs, _, func = AnalysisPipeline.STAGES[name]
+            args = [get(i) for i in inputs]
+            with timer.span(AnalysisPipeline.STAGE_LABELS[name]):
+                # 清理階段內含整份資料的複製，另以子區段記錄其耗時與記憶體
+                value = func(params, *args, timer=timer) if name == 'prepared' else func(params, *args)
+            # 清理失敗不寫入快取，修正資料後可重新嘗試
+            if name == 'prepared' and value[0] is None: values[name] = value
+            else: store(name, value)
+            return value
+
+        return get
+
+    @staticmethod
+    def run(df_input, params, process=None, timer=None, cache=None, data_key=None):
+        """依 DAG 取得報告所需的各階段結果 (參數說明見 _evaluator)"""
+        get = AnalysisPipeline._evaluator(df_input, params, process, timer, cache, data_key)
+        df, _, scope = get('prepared')
+        if df is None: return None, None, scope, None, {}
+        figs = {name: get(f"fig_{name}") for name in AnalysisPipeline.FIGURES}
+        return get('losses'), get('summary'), scope, get('texts'), figs
+
+    @staticmethod
+    def what_if(df_input, params, cache=None, key=None, process=None, timer=None):
+        """回傳 (WhatIfModel, 不含損失的群組統計)；兩者都只與資料有關，參數變動時直接沿用快取"""
+        get = AnalysisPipeline._evaluator(df_input, params, process, timer, cache, key)
+        if get('prepared')[0] is None: return None, None
+        return get('whatif'), get('group_stats')
+
+    @staticmethod
+    def sensitivity(df_input, params, cache=None, key=None, process=None, timer=None):
+        """回傳參數敏感度結果 (見 SensitivityAnalysis.analyze)；資料清理失敗時回傳 None"""
+        get = AnalysisPipeline._evaluator(df_input, params, process, timer, cache, key)
+        if get('prepared')[0] is None: return None
+        return get('sensitivity')
+
+    @staticmethod
+    def run_cached(df_input, params, cache, key=None, process=None, timer=None):
+        """以共用快取執行 DAG；key 為資料本身的雜湊 (不含參數)，省略時自動計算"""
+        timer = timer or StageTimer.DISABLED
+        if key is None:
+            with timer.span("資料雜湊"): key = AnalysisPipeline.fingerprint(df_input)
+        return AnalysisPipeline.run(df_input, params, process, timer, cache, key)
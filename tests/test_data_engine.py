@@ -0,0 +1,98 @@
+# DataEngine 向量化衍生欄位與原本逐列 lambda 的等價性測試 (含 NaN、零值與負值)
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine import DataEngine
+
+PARAMS = [
+    {'elec_price': 3.5, 'target_oee': 85.0, 'product_margin': 10.0},
+    {'elec_price': 0.0, 'target_oee': 0.0, 'product_margin': 7.25},
+    {'elec_price': 4.2, 'target_oee': 120.0, 'product_margin': -3.0},
+]
+
+def random_rows(seed, n=2000):
+    rng = np.random.default_rng(seed)
+    def column(low, high):
+        values = rng.uniform(low, high, n)
+        # 約各一成為 NaN、零值、負值；OEE 另混入小數比例 (0~1) 的填法
+        kind = rng.integers(0, 10, n)
+        values[kind == 0] = np.nan
+        values[kind == 1] = 0.0
+        values[kind == 2] = -values[kind == 2]
+        return values
+    oee = column(0, 100)
+    oee[::7] = oee[::7] / 100
+    return pd.DataFrame({"OEE_RAW": oee, "產量": column(0, 5000), "耗電量": column(0, 20)})
+
+def original_metrics(df, params):
+    """原本逐列 apply 的實作"""
+    df = df.copy()
+    df["OEE"] = df["OEE_RAW"].apply(lambda x: x / 100.0 if x > 1.0 else x)
+    df["單位能耗"] = df.apply(lambda row: row["耗電量"] / row["產量"] if row["產量"] > 0 else 0, axis=1)
+    best_energy = df[df["單位能耗"] > 0]["單位能耗"].min()
+    if pd.isna(best_energy): best_energy = 0
+    df["能源損失"] = df.apply(lambda row: max(0, (row["單位能耗"] - best_energy) * row["產量"] * params['elec_price']), axis=1)
+    df["產能損失機會成本"] = df.apply(
+        lambda row: ((params['target_oee']/100 - row["OEE"]) / row["OEE"] * row["產量"] * params['product_margin'])
+        if 0 < row["OEE"] < params['target_oee']/100 else 0, axis=1
+    )
+    return df, best_energy
+
+def vectorized_metrics(df, params):
+    df = DataEngine.compute_metrics(df.copy())
+    best_energy = DataEngine.best_unit_energy(df)
+    return DataEngine.compute_losses(df, best_energy, params), best_energy
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("params", PARAMS)
+def test_vectorized_matches_original_lambdas(seed, params):
+    df = random_rows(seed)
+    expected, expected_best = original_metrics(df, params)
+    actual, actual_best = vectorized_metrics(df, params)
+    assert actual_best == expected_best
+    for col in ["OEE", "單位能耗", "能源損失", "產能損失機會成本"]:
+        assert np.array_equal(actual[col].to_numpy(dtype="float64"), expected[col].to_numpy(dtype="float64"), equal_nan=True), col
+
+def test_no_positive_unit_energy():
+    df = pd.DataFrame({"OEE_RAW": [50.0, np.nan, 0.0], "產量": [0.0, -10.0, np.nan], "耗電量": [5.0, 3.0, 1.0]})
+    expected, expected_best = original_metrics(df, PARAMS[0])
+    actual, actual_best = vectorized_metrics(df, PARAMS[0])
+    assert actual_best == expected_best == 0
+    for col in ["OEE", "單位能耗", "能源損失", "產能損失機會成本"]:
+        assert np.array_equal(actual[col].to_numpy(dtype="float64"), expected[col].to_numpy(dtype="float64"), equal_nan=True), col
+
+def original_clean_and_process(df_raw, params):
+    """原本 clean_and_process 的計算 (逐列 apply，全程 float64；日期欄不在此比較)"""
+    df = df_raw.rename(columns=DataEngine.RENAME_MAP)
+    df, _ = original_metrics(df, params)
+    df["總損失"] = df["能源損失"] + df["產能損失機會成本"]
+    group_col = "廠別" if df["廠別"].nunique() > 1 else "機台編號"
+    summary_agg = df.groupby(group_col).agg({
+        "OEE": "mean", "產量": "sum", "耗電量": "sum",
+        "能源損失": "sum", "產能損失機會成本": "sum", "總損失": "sum"
+    }).reset_index()
+    summary_agg["平均單位能耗"] = summary_agg.apply(lambda row: row["耗電量"] / row["產量"] if row["產量"] > 0 else 0, axis=1)
+    return df, summary_agg.sort_values("OEE", ascending=False)
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("params", PARAMS)
+def test_clean_and_process_matches_original(seed, params):
+    # 端到端比較：包含型別精簡 (整數欄可降為 float32，一位小數欄不可) 之後的損失與群組彙總
+    rng = np.random.default_rng(seed)
+    n = 3000
+    raw = pd.DataFrame({
+        "廠別": rng.choice(["A廠", "B廠", "C廠"], n), "機台編號": rng.choice([f"M{i}" for i in range(8)], n),
+        "OEE(%)": rng.uniform(10, 100, n).round(1), "產量(雙)": rng.uniform(10, 100, n).round(1),
+        "用電量(kWh)": rng.integers(0, 50, n).astype("float64"),
+    })
+    raw.loc[raw.index[::11], "產量(雙)"] = np.nan
+    raw.loc[raw.index[::13], "產量(雙)"] = 0.0
+    raw.loc[raw.index[::17], "用電量(kWh)"] = -3.0
+    expected_df, expected_summary = original_clean_and_process(raw, params)
+    df, summary, _ = DataEngine.clean_and_process(raw, params)
+    for col in ["OEE", "單位能耗", "能源損失", "產能損失機會成本", "總損失"]:
+        assert np.array_equal(df[col].to_numpy(dtype="float64"), expected_df[col].to_numpy(dtype="float64"), equal_nan=True), col
+    assert summary["廠別"].tolist() == expected_summary["廠別"].tolist()
+    for col in ["OEE", "產量", "耗電量", "能源損失", "產能損失機會成本", "總損失", "平均單位能耗"]:
+        assert np.array_equal(summary[col].to_numpy(dtype="float64"), expected_summary[col].to_numpy(dtype="float64"), equal_nan=True), col
@@ -0,0 +1,54 @@
+# HistoryStore：從資料庫載回的資料再存入時不可重複計入
+import numpy as np
+import pandas as pd
+
+from engine import AnalysisPipeline, DataEngine, HistoryStore
+
+PARAMS = {'elec_price': 3.5, 'target_oee': 85.0, 'product_margin': 10.0}
+
+def raw_frame(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "日期": pd.Timestamp("2025-01-01") + pd.to_timedelta(np.arange(n) // 10, "D"),
+        "廠別": np.where(np.arange(n) % 10 < 5, "A廠", "B廠"), "機台編號": [f"M{i % 5}" for i in range(n)],
+        "OEE(%)": rng.uniform(30, 95, n).round(1), "產量(雙)": rng.uniform(0, 3000, n).round(1),
+        "用電量(kWh)": rng.uniform(2, 20, n).round(2),
+    })
+
+def save(store, raw, source):
+    df, _, _ = DataEngine.clean_and_process(raw, PARAMS)
+    return store.append(df, AnalysisPipeline.fingerprint(raw), source)
+
+def test_reloaded_rows_are_not_duplicated(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite"))
+    raw = raw_frame()
+    assert save(store, raw, "a.csv") == len(raw)
+    assert save(store, raw, "a.csv") == 0
+
+    reloaded = store.query(columns=HistoryStore.INPUT_COLS)
+    reloaded.loc[0, "產量"] = 1.0
+    assert save(store, reloaded, "history") == 0
+    result = store.query()
+    assert len(result) == len(raw)
+    assert result.loc[0, "產量"] == 1.0
+    assert result["產量"].sum() == reloaded["產量"].sum()
+
+def test_query_by_date_and_machine(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite"))
+    raw = raw_frame()
+    save(store, raw, "a.csv")
+    result = store.query("2025-01-03", "2025-01-04", machines=["M1", "M2"])
+    expected = raw[raw["日期"].between("2025-01-03", "2025-01-04") & raw["機台編號"].isin(["M1", "M2"])]
+    assert len(result) == len(expected)
+    np.testing.assert_allclose(result["產量"].sum(), expected["產量(雙)"].sum())
+
+def test_multiple_rows_per_machine_day_are_kept(tmp_path):
+    # 同一天同一機台有多筆 (例如多個班別) 時全部保留，載回後再存入也不重複
+    store = HistoryStore(str(tmp_path / "history.sqlite"))
+    raw = pd.concat([raw_frame(seed=1), raw_frame(seed=2)], ignore_index=True)
+    assert save(store, raw, "shifts.csv") == len(raw)
+    reloaded = store.query(columns=HistoryStore.INPUT_COLS)
+    assert save(store, reloaded, "history") == 0
+    result = store.query()
+    assert len(result) == len(raw)
+    np.testing.assert_allclose(result["產量"].sum(), raw["產量(雙)"].sum())
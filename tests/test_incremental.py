@@ -0,0 +1,111 @@
+# IncrementalProcessor 與串流彙總必須與 clean_and_process 全量計算結果一致 (含空白廠別/機台的列)
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine import DataEngine, IncrementalProcessor
+
+PARAMS = {'elec_price': 3.5, 'target_oee': 85.0, 'product_margin': 10.0}
+SUMMARY_COLS = ["OEE", "產量", "耗電量", "能源損失", "產能損失機會成本", "總損失", "平均單位能耗"]
+
+def base_frame(n=400, seed=0, plants=("A廠", "B廠")):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "日期": pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.integers(0, 30, n), "D"),
+        "廠別": rng.choice(list(plants), n), "機台編號": rng.choice([f"M{i}" for i in range(6)], n),
+        "OEE(%)": rng.uniform(30, 95, n).round(1), "產量(雙)": rng.uniform(0, 3000, n).round(1),
+        "用電量(kWh)": rng.uniform(2, 20, n).round(2),
+    })
+
+def apply_delta(base, delta):
+    """模擬 st.data_editor：依差異產生編輯後的資料 (新增列接在原索引之後)"""
+    edited = base.copy()
+    for pos, changes in delta["edited_rows"].items():
+        for col, value in changes.items(): edited.iloc[pos, edited.columns.get_loc(col)] = value
+    edited = edited.drop(index=base.index[delta["deleted_rows"]])
+    if delta["added_rows"]:
+        start = len(base)
+        added = pd.DataFrame(delta["added_rows"], index=range(start, start + len(delta["added_rows"])))
+        edited = pd.concat([edited, added])
+    return edited
+
+def assert_matches_full(df, summary, scope, edited, params):
+    ref_df, ref_summary, ref_scope = DataEngine.clean_and_process(edited, params)
+    assert scope == ref_scope
+    group_col = "廠別" if scope == "跨廠區分析" else "機台編號"
+    a, b = summary.set_index(group_col).sort_index(), ref_summary.set_index(group_col).sort_index()
+    assert a.index.equals(b.index)
+    np.testing.assert_allclose(a[SUMMARY_COLS].to_numpy(float), b[SUMMARY_COLS].to_numpy(float), rtol=1e-9)
+    assert df.index.equals(ref_df.index)
+    for col in ["OEE", "單位能耗", "能源損失", "產能損失機會成本", "總損失"]:
+        np.testing.assert_allclose(df[col].to_numpy(float), ref_df[col].to_numpy(float), rtol=1e-9)
+
+def best_row(base):
+    df, _, _ = DataEngine.clean_and_process(base, PARAMS)
+    return int(np.argmin(np.where(df["單位能耗"] > 0, df["單位能耗"], np.inf)))
+
+STEPS = {
+    'edit': lambda delta, base: delta["edited_rows"].update({5: {"OEE(%)": 12.0}, 9: {"產量(雙)": 0.0}}),
+    'delete_best': lambda delta, base: delta["deleted_rows"].append(best_row(base)),
+    'add': lambda delta, base: delta["added_rows"].append(
+        {"日期": pd.Timestamp("2025-02-01"), "廠別": "C廠", "機台編號": "X", "OEE(%)": 40.0, "產量(雙)": 5000.0, "用電量(kWh)": 0.01}),
+    'add_blank_plant': lambda delta, base: delta["added_rows"].append(
+        {"日期": pd.Timestamp("2025-02-02"), "廠別": None, "機台編號": "M1", "OEE(%)": 70.0, "產量(雙)": 1000.0, "用電量(kWh)": 3.0}),
+    'add_blank_machine': lambda delta, base: delta["added_rows"].append(
+        {"日期": pd.Timestamp("2025-02-03"), "廠別": "A廠", "機台編號": None, "OEE(%)": 99.0, "產量(雙)": 800.0, "用電量(kWh)": 2.0}),
+    'edit_blank_plant': lambda delta, base: delta["edited_rows"].update({3: {"廠別": None}}),
+}
+
+@pytest.mark.parametrize("plants", [("A廠", "B廠"), ("A廠",)])
+@pytest.mark.parametrize("step", list(STEPS))
+def test_single_step_matches_full(step, plants):
+    base = base_frame(plants=plants)
+    inc = IncrementalProcessor(base, PARAMS)
+    delta = {"edited_rows": {}, "added_rows": [], "deleted_rows": []}
+    assert_matches_full(*inc.process(apply_delta(base, delta), copy.deepcopy(delta)), apply_delta(base, delta), PARAMS)
+    STEPS[step](delta, base)
+    edited = apply_delta(base, delta)
+    assert_matches_full(*inc.process(edited, copy.deepcopy(delta)), edited, PARAMS)
+
+def test_step_sequence_with_param_changes():
+    base = base_frame(seed=1)
+    params = dict(PARAMS)
+    inc = IncrementalProcessor(base, params)
+    delta = {"edited_rows": {}, "added_rows": [], "deleted_rows": []}
+    inc.process(apply_delta(base, delta), copy.deepcopy(delta))
+    for k, step in enumerate(STEPS.values()):
+        if k % 2:
+            params = dict(params, elec_price=params['elec_price'] + 0.5, target_oee=params['target_oee'] - 2)
+            inc.set_params(params)
+        step(delta, base)
+        edited = apply_delta(base, delta)
+        assert_matches_full(*inc.process(edited, copy.deepcopy(delta)), edited, params)
+
+def test_blank_keys_in_initial_data():
+    base = base_frame(seed=2)
+    base.loc[[1, 2], "廠別"] = None
+    base.loc[[3, 4], "機台編號"] = None
+    inc = IncrementalProcessor(base, PARAMS)
+    assert_matches_full(*inc.process(base, {}), base, PARAMS)
+
+@pytest.mark.parametrize("plants", [("A廠", "B廠"), ("A廠",)])
+def test_csv_stream_matches_full(tmp_path, plants):
+    raw = base_frame(n=3000, seed=3, plants=plants)
+    raw["日期"] = raw["日期"].dt.strftime("%Y-%m-%d")
+    raw.loc[[1, 2, 50], "廠別"] = None
+    raw.loc[[3, 4, 60], "機台編號"] = None
+    path = tmp_path / "data.csv"
+    raw.to_csv(path, index=False)
+
+    summary, kpis, scope = DataEngine.process_csv_stream(str(path), PARAMS)
+    df, ref_summary, ref_scope = DataEngine.clean_and_process(pd.read_csv(path), PARAMS)
+    assert scope == ref_scope
+    group_col = "廠別" if scope == "跨廠區分析" else "機台編號"
+    a, b = summary.set_index(group_col).sort_index(), ref_summary.set_index(group_col).sort_index()
+    assert a.index.equals(b.index)
+    np.testing.assert_allclose(a[SUMMARY_COLS].to_numpy(float), b[SUMMARY_COLS].to_numpy(float), rtol=1e-9)
+    assert kpis["rows"] == len(df)
+    assert kpis["avg_oee"] == pytest.approx(df["OEE"].mean(), rel=1e-12)
+    assert kpis["total_loss"] == pytest.approx(df["總損失"].sum(), rel=1e-9)